@@ -0,0 +1,59 @@
+import logging
+import urlparse
+
+from gevent.pywsgi import WSGIServer
+
+from redditbot.base.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class AdminServer(object):
+    """
+    Small HTTP server for local operational endpoints, running in a greenlet of the bot process.
+    Serves /metrics (the Prometheus text format) out of the box; more endpoints are added with route().
+    A route is called with the query parameters (name -> first value) and returns the response text,
+    or raises ValueError for a bad request.
+    """
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self.server = None
+        self.route('/metrics', lambda params: registry.render())
+
+    def route(self, path, fn):
+        self.routes[path] = fn
+
+    def start(self):
+        self.server = WSGIServer((self.host, self.port), self._app, log=None)
+        self.server.start()
+        logger.info('Admin endpoint listening on {host}:{port}'.format(host=self.host, port=self.server.server_port))
+        return self.server
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+
+    def _app(self, environ, start_response):
+        fn = self.routes.get(environ.get('PATH_INFO', ''))
+        if fn is None:
+            return self._respond(start_response, '404 Not Found', 'Not found\n')
+
+        params = dict((k, v[0]) for k, v in urlparse.parse_qs(environ.get('QUERY_STRING', '')).iteritems())
+        try:
+            return self._respond(start_response, '200 OK', fn(params))
+        except ValueError as e:
+            return self._respond(start_response, '400 Bad Request', '{e}\n'.format(e=e))
+        except Exception as e:
+            logger.exception('Exception while serving {path}'.format(path=environ.get('PATH_INFO')))
+            return self._respond(start_response, '500 Internal Server Error', 'Internal error\n')
+
+    def _respond(self, start_response, status, body):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        start_response(status, [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
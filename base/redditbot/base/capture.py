@@ -0,0 +1,140 @@
+import gzip
+import time
+import zlib
+import logging
+
+import simplejson
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+GZIP_MAGIC = '\x1f\x8b\x08'
+
+
+def read_capture(path):
+    """
+    Yields the records of a capture file in the order they were written.
+    A writer that died before close() leaves its gzip member without a trailer, which the gzip module rejects,
+    so the file is decompressed here: a cut member is read up to its last complete record.
+    """
+    buf = ''
+    with open(path, 'rb') as f:
+        for data in _decompress(f):
+            if data is None:
+                _warn_truncated(path, buf)
+                buf = ''
+                continue
+            lines = (buf + data).split('\n')
+            buf = lines.pop()
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    yield simplejson.loads(line)
+                except ValueError as e:
+                    logger.warn('Skipping a record of {path} that does not decode: {e}'.format(path=path, e=e))
+    _warn_truncated(path, buf)
+
+
+def _warn_truncated(path, buf):
+    if buf.strip():
+        logger.warn('Capture {path} has a truncated record, ignoring it'.format(path=path))
+
+
+def _decompress(f, chunk_size=64 * 1024):
+    """
+    Yields the data of every gzip member of f, and None where a member was cut short.
+    """
+    start = 0
+    while start is not None:
+        # Every process appending to the file starts a new gzip member
+        member = start
+        produced = 0
+        try:
+            for data, start in _inflate(f, member, None, chunk_size):
+                produced += len(data)
+                yield data
+        except zlib.error:
+            # A member without its trailer runs into the next one, which starts at the next gzip header. zlib drops
+            # the data of the read that failed, so the member is read again up to there
+            start = _find_member(f, member + 1)
+            try:
+                for data, _ in _inflate(f, member, start, chunk_size):
+                    skip = min(produced, len(data))
+                    produced -= skip
+                    yield data[skip:]
+            except zlib.error:
+                pass
+            yield None
+
+
+def _inflate(f, start, end, chunk_size):
+    # Yields the data of the member at start, read up to end, with where the next member starts once it ended
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    f.seek(start)
+    while end is None or f.tell() < end:
+        data = f.read(chunk_size if end is None else min(chunk_size, end - f.tell()))
+        if not data:
+            return
+        output = decompressor.decompress(data)
+        if decompressor.unused_data:
+            yield output, f.tell() - len(decompressor.unused_data)
+            return
+        yield output, None
+
+
+def _find_member(f, offset, chunk_size=64 * 1024):
+    while True:
+        f.seek(offset)
+        data = f.read(chunk_size)
+        i = data.find(GZIP_MAGIC)
+        if i >= 0:
+            return offset + i
+        if len(data) < chunk_size:
+            return None
+        offset += len(data) - len(GZIP_MAGIC) + 1
+
+
+class CaptureWriter(object):
+    """
+    Records what handlers fetched from reddit into a gzip compressed file of json lines, so it can be replayed
+    later (see redditbot.base.replay). Every handler of a process can share one writer.
+    Each cycle's listing becomes a 'listing' record and the things looked up by id become 'things' records,
+    both holding the raw json reddit returned for every thing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'ab')
+
+    def record_listing(self, handler, things):
+        self._write({'type': 'listing', 'handler': handler, 'time': time.time(), 'things': self._dump(things)})
+
+    def record_things(self, handler, things):
+        self._write({'type': 'things', 'handler': handler, 'time': time.time(), 'things': self._dump(things)})
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def _dump(self, things):
+        dumped = []
+        for thing in things:
+            if thing is None:
+                continue
+            if getattr(thing, 'json_dict', None) is None:
+                logger.warn('Not capturing {name}: no json stored for it'.format(name=thing.fullname))
+                continue
+
+            # Replies are only loaded when fetched through the submission, and replay never needs them
+            data = dict(thing.json_dict)
+            if 'replies' in data:
+                data['replies'] = ''
+
+            dumped.append({'kind': thing.fullname.split('_', 1)[0], 'data': data})
+        return dumped
+
+    def _write(self, record):
+        self.file.write(simplejson.dumps(record, default=lambda o: None) + '\n')
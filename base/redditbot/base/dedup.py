@@ -0,0 +1,190 @@
+import os
+import math
+import time
+import struct
+import sqlite3
+import hashlib
+import logging
+
+import pylru
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class LruDedup(object):
+    """
+    Remembers the most recently seen ids in memory only.
+    """
+
+    def __init__(self, size):
+        self.cache = pylru.lrucache(size)
+
+    def __contains__(self, item_id):
+        return item_id in self.cache
+
+    def add(self, item_id):
+        self.cache[item_id] = 0
+
+    def flush(self):
+        pass
+
+
+class PersistentDedup(object):
+    """
+    Remembers seen ids in an SQLite table so they survive restarts, with an LRU cache in front as a hot tier.
+    New ids are written once per cycle on flush(), and ids older than max_age are compacted away periodically.
+    """
+
+    def __init__(self, db_path, namespace, cache_size, max_age=7 * 24 * 3600, compact_interval=3600):
+        # Create the path if it does not already exist
+        if os.path.dirname(db_path) and not os.path.exists(os.path.dirname(db_path)):
+            os.makedirs(os.path.dirname(db_path))
+
+        self.db_path = db_path
+        self.namespace = namespace
+        self.max_age = max_age
+        self.compact_interval = compact_interval
+        self.hot = pylru.lrucache(cache_size)
+        self.pending = {}
+        self.last_compact = 0
+        self.conn = sqlite3.connect(self.db_path)
+        self.create()
+
+    def create(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS seen_items (
+                namespace TEXT,
+                item_id TEXT,
+                time INTEGER NOT NULL,
+                PRIMARY KEY(namespace, item_id)
+            );
+            """)
+
+        self.conn.execute('CREATE INDEX IF NOT EXISTS seen_items_time ON seen_items(time);')
+        self.conn.commit()
+
+    def __contains__(self, item_id):
+        if item_id in self.hot or item_id in self.pending:
+            return True
+
+        cursor = self.conn.execute(
+            'SELECT 1 FROM seen_items WHERE namespace = ? AND item_id = ?',
+            (self.namespace, item_id)
+        )
+        if cursor.fetchone() is None:
+            return False
+
+        # Promote to the hot tier
+        self.hot[item_id] = 0
+        return True
+
+    def add(self, item_id):
+        self.hot[item_id] = 0
+        self.pending[item_id] = int(time.time())
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO seen_items VALUES(?, ?, ?)',
+                [(self.namespace, item_id, t) for item_id, t in self.pending.iteritems()]
+            )
+            self.conn.commit()
+            self.pending = {}
+
+        now = time.time()
+        if now - self.last_compact > self.compact_interval:
+            self.compact(now)
+
+    def compact(self, now):
+        cursor = self.conn.execute(
+            'DELETE FROM seen_items WHERE namespace = ? AND time < ?',
+            (self.namespace, int(now - self.max_age))
+        )
+        self.conn.commit()
+        self.last_compact = now
+        if cursor.rowcount > 0:
+            logger.info('Compacted {count} seen ids for {name}'.format(count=cursor.rowcount, name=self.namespace))
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class BloomFilter(object):
+    """
+    Fixed size Bloom filter sized for capacity ids at the given false positive rate.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item_id):
+        if isinstance(item_id, unicode):
+            item_id = item_id.encode('utf-8')
+        # Double hashing: derive every position from the two halves of one digest
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item_id).digest())
+        return [(h1 + i * h2) % self.num_bits for i in xrange(self.num_hashes)]
+
+    def __contains__(self, item_id):
+        for pos in self._positions(item_id):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, item_id):
+        for pos in self._positions(item_id):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def size_bytes(self):
+        return len(self.bits)
+
+
+class RotatingBloomDedup(object):
+    """
+    Remembers seen ids in a ring of Bloom filters, so memory stays constant however many ids go through it.
+    A new slice is started every window / (slices - 1) seconds, or once capacity / (slices - 1) ids were added to
+    the current one, and the oldest slice is dropped. An id is therefore remembered for at least window seconds
+    as long as fewer than capacity ids arrive in that time. Unseen ids are reported as seen with a probability of
+    about error_rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.001, window=24 * 3600, slices=2):
+        if slices < 2:
+            raise Exception("slices must be at least 2")
+
+        self.slice_capacity = max(1, capacity // (slices - 1))
+        self.slice_error_rate = error_rate / slices
+        self.slice_duration = window / float(slices - 1)
+        self.slices = slices
+        self.filters = []
+        self.started = 0
+        self._rotate()
+
+    def _rotate(self):
+        self.filters.append(BloomFilter(self.slice_capacity, self.slice_error_rate))
+        if len(self.filters) > self.slices:
+            self.filters.pop(0)
+        self.started = time.time()
+
+    def __contains__(self, item_id):
+        for f in self.filters:
+            if item_id in f:
+                return True
+        return False
+
+    def add(self, item_id):
+        current = self.filters[-1]
+        if current.count >= self.slice_capacity or time.time() - self.started >= self.slice_duration:
+            self._rotate()
+            current = self.filters[-1]
+        current.add(item_id)
+
+    def flush(self):
+        logger.info('Bloom dedup ids/bytes: {count} / {size}'.format(count=sum(f.count for f in self.filters),
+                                                                     size=sum(f.size_bytes() for f in self.filters)))
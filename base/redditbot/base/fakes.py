@@ -0,0 +1,69 @@
+import collections
+
+
+class FakeRedditor(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeSubreddit(object):
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class FakeComment(object):
+    """
+    Stand-in for praw.objects.Comment with the attributes the handlers and utils read.
+    """
+
+    def __init__(self, id, body, subreddit='all', author='someone', parent_id=None, link_id='t3_0', score=1,
+                 created_utc=0):
+        self.id = id
+        self.fullname = 't1_' + id
+        self.name = self.fullname
+        self.body = body
+        self.subreddit = FakeSubreddit(subreddit)
+        self.author = FakeRedditor(author) if author else None
+        self.parent_id = parent_id or link_id
+        self.link_id = link_id
+        self.score = score
+        self.created_utc = created_utc
+        self.permalink = 'https://www.reddit.com/r/{sub}/comments/{link}/_/{id}'.format(sub=subreddit,
+                                                                                        link=link_id[3:], id=id)
+        self.replies = []
+        self.reddit_session = None
+
+
+class FakeReddit(object):
+    """
+    Stand-in for a praw.Reddit session that answers from memory and counts the calls made to it.
+    things maps fullnames to the objects get_info returns, listings maps a listing name to its items.
+    """
+
+    def __init__(self, things=None, listings=None):
+        self.things = things if things is not None else {}
+        self.listings = listings if listings is not None else {}
+        self.calls = collections.Counter()
+        self.user = None
+        self.access_token = None
+
+    def login(self, username, password):
+        self.calls['login'] += 1
+        self.user = FakeRedditor(username)
+
+    def set_oauth_app_info(self, **kwargs):
+        pass
+
+    def set_access_credentials(self, scope, access_token, update_user=True):
+        self.calls['access_token'] += 1
+        self.access_token = access_token
+
+    def get_info(self, thing_id):
+        self.calls['get_info'] += 1
+        if isinstance(thing_id, list):
+            return [self.things[t] for t in thing_id if t in self.things]
+        return self.things.get(thing_id)
+
+    def get_comments(self, subreddit, limit=None):
+        self.calls['get_comments'] += 1
+        return iter(self.listings.get('comments', [])[:limit])
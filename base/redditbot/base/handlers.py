@@ -1,43 +1,156 @@
 import time
+import heapq
+import signal
 import logging
+import tempfile
 
 import gevent
+import gevent.local
+import gevent.pool
+import gevent.queue
 import praw
-import pylru
 import requests
 import requests.auth
 
+from redditbot.base import metrics
+from redditbot.base.dedup import LruDedup, PersistentDedup
+from redditbot.base.profiling import PROFILE_LOCK, CycleProfiler, PhaseTimer
+from redditbot.base.ratelimit import GovernedHandler, get_governor
+from redditbot.base.scheduler import AdaptivePollScheduler
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 OAUTH_ACCESS_TOKEN_URL = 'https://www.reddit.com/api/v1/access_token'
 
+CYCLE_SECONDS = metrics.histogram('redditbot_cycle_seconds', 'Duration of fetch/process cycles', ['handler'])
+CYCLE_ERRORS = metrics.counter('redditbot_cycle_errors_total', 'Cycles that raised', ['handler'])
+PHASE_SECONDS = metrics.histogram('redditbot_phase_seconds',
+                                  'Time in get_content (the whole listing) and in check/do (per item)',
+                                  ['handler', 'phase'])
+ITEMS = metrics.counter('redditbot_items_total', 'Items processed, by outcome (valid, skipped or error)',
+                        ['handler', 'result'])
+DEDUP_LOOKUPS = metrics.counter('redditbot_dedup_lookups_total', 'Dedup lookups, by result (hit or miss)',
+                                ['handler', 'result'])
+POLL_DELAY = metrics.gauge('redditbot_poll_delay_seconds', 'Delay between the starts of two polls', ['handler'])
+COVERAGE = metrics.gauge('redditbot_listing_coverage_ratio',
+                         'Share of the items since the previous cycle that the last listing reached', ['handler'])
+MISSED_ITEMS = metrics.counter('redditbot_listing_missed_items_total',
+                               'Items estimated to have been missed between two listings that did not overlap',
+                               ['handler'])
+
 
 class MultiBotHandler(object):
     def __init__(self, handlers):
         self.handlers = handlers
+        self.greenlets = []
 
     def run(self):
-        greenlets = []
+        self.greenlets = []
+        for handler in self.handlers:
+            self.greenlets.append(gevent.spawn(handler.run))
+        gevent.joinall(self.greenlets)
+
+    def stop(self):
+        """
+        Kills the handlers, then writes out the ids their dedup caches have yet to flush.
+        """
+        gevent.killall(self.greenlets)
         for handler in self.handlers:
-            greenlets.append(gevent.spawn(handler.run))
-        gevent.joinall(greenlets)
+            if handler.cache is not None:
+                handler.cache.flush()
+
+    def profile(self, name=None, cycles=1):
+        """
+        Profiles the next cycles of the handler called name, or of every handler if name is None.
+        """
+        handlers = [handler for handler in self.handlers if name is None or handler.name == name]
+        if not handlers:
+            raise ValueError('No handler named {name}'.format(name=name))
+        for handler in handlers:
+            handler.profile(cycles)
+        return 'Profiling {cycles} cycles of {names}\n'.format(cycles=cycles,
+                                                               names=', '.join(h.name for h in handlers))
+
+    def install_controls(self, admin=None, signum=signal.SIGUSR1, cycles=3):
+        """
+        Lets profiling be started at runtime: signum profiles the next cycles of every handler, and the
+        /profile?handler=<name>&cycles=<n> route of admin (an AdminServer) profiles a single handler.
+        """
+        signal.signal(signum, lambda *_: self.profile(cycles=cycles))
+        if admin is not None:
+            admin.route('/profile', lambda params: self.profile(params.get('handler'),
+                                                                int(params.get('cycles', cycles))))
 
 
 class BotHandler(object):
-    def __init__(self, user_agent, auth, delay, fetch_limit, cache_size=0, dry_run=False):
+    def __init__(self, user_agent, auth, delay, fetch_limit, cache_size=0, dry_run=False, rate_governor=None,
+                 seen_db_path=None, name=None, dedup=None, min_delay=None, max_delay=None, concurrency=1,
+                 ordered_dedup=True, capture=None, clock=None, profile_dir=None, slow_items=3,
+                 catch_up=False, catch_up_limit=1000):
+        self.name = name or type(self).__name__
         self.user_agent = user_agent
         self.auth = auth
         self.delay = delay
+        self.scheduler = None
+        if min_delay is not None or max_delay is not None:
+            self.scheduler = AdaptivePollScheduler(delay, min_delay or delay, max_delay or delay)
         self.fetch_limit = fetch_limit
         self.cache_size = cache_size
         self.dry_run = dry_run
-        self.cache = pylru.lrucache(self.cache_size) if self.cache_size > 0 else None
+        self.concurrency = concurrency
+        self.ordered_dedup = ordered_dedup
+        self.pool = gevent.pool.Pool(self.concurrency) if self.concurrency > 1 else None
+        self.local = gevent.local.local()
+        self.sessions = None
+        self.worker_sessions = []
+        self.seen_db_path = seen_db_path
+
+        # Anything with time()/sleep() can stand in for the time module, e.g. a virtual clock when replaying
+        self.clock = clock or time
+        self.capture = capture
+
+        # Profiles are written to profile_dir; the slowest items of every cycle are logged
+        self.profile_dir = profile_dir or tempfile.gettempdir()
+        self.profiler = None
+        self.slow_items = slow_items
+        self.item_times = []
+        self.failed_items = []
+
+        # Any object with __contains__/add/flush can be passed in as the dedup backend
+        if dedup is not None:
+            self.cache = dedup
+        elif self.seen_db_path:
+            self.cache = PersistentDedup(self.seen_db_path, self.name, self.cache_size or 1000)
+        elif self.cache_size > 0:
+            self.cache = LruDedup(self.cache_size)
+        else:
+            self.cache = None
         self.api_request_delay = 1.0 if self.__is_oauth() else 2.0
-        self.r = praw.Reddit(self.user_agent, cache_timeout=0, api_request_delay=self.api_request_delay)
+
+        # Requests are paced by a governor shared by all handlers of the account rather than praw's fixed delay
+        self.rate_governor = rate_governor or get_governor(self.auth.get('username', ''), 1.0 / self.api_request_delay)
+        self.session = self._new_session()
         self.expires = -1
+        self.watermark = None
+        self.catch_up = catch_up
+        self.catch_up_limit = catch_up_limit
+        self.things = {}
         self.__auth()
 
+    @property
+    def r(self):
+        """
+        The praw session of the current greenlet: a worker session while processing in the pool, the main one otherwise.
+        """
+        return getattr(self.local, 'r', None) or self.session
+
+    def _new_session(self):
+        # Captured things are written out from the raw json praw keeps when store_json_result is on
+        kwargs = {'store_json_result': 'true'} if self.capture is not None else {}
+        return praw.Reddit(self.user_agent, cache_timeout=0, api_request_delay=0,
+                           handler=GovernedHandler(self.rate_governor, self.name), **kwargs)
+
     def _get_content(self):
         raise NotImplementedError()
 
@@ -47,6 +160,116 @@ class BotHandler(object):
     def _do(self, obj):
         raise NotImplementedError()
 
+    def _get_prefetch_ids(self, obj):
+        """
+        Returns the fullnames that processing obj is expected to look up (usually its parent),
+        so they can be fetched in bulk for the whole cycle. It is asked again once those are in self.things,
+        for lookups that depend on them (like the parent of a fetched comment).
+        """
+        return []
+
+    def get_thing(self, thing_id):
+        """
+        Returns the thing with the given fullname, or None if it does not exist.
+        Things prefetched for the current cycle are served without a request.
+        """
+        if thing_id in self.things:
+            return self.things[thing_id]
+        thing = self.r.get_info(thing_id=thing_id)
+        if self.capture is not None:
+            self.capture.record_things(self.name, [thing])
+        return thing
+
+    def __prefetch(self, objs, rounds=2):
+        self.things = {}
+        for _ in xrange(rounds):
+            thing_ids = set()
+            for obj in objs:
+                try:
+                    thing_ids.update(self._get_prefetch_ids(obj))
+                except Exception as e:
+                    logger.exception('Exception while collecting prefetch ids of {id}'.format(id=obj.id))
+            thing_ids.difference_update(self.things)
+            if not thing_ids:
+                return
+
+            # get_info looks up 100 ids per request
+            try:
+                things = self.r.get_info(thing_id=list(thing_ids)) or []
+            except Exception as e:
+                logger.exception('Exception while prefetching things')
+                return
+
+            if self.capture is not None:
+                self.capture.record_things(self.name, things)
+
+            # Ids that did not come back do not exist anymore
+            self.things.update(dict.fromkeys(thing_ids))
+            for thing in things:
+                self.things[thing.fullname] = thing
+            logger.info('Prefetched things found/total: {found} / {total}'.format(found=len(things),
+                                                                                  total=len(thing_ids)))
+
+    def _activity(self, new_items, valid_items):
+        """
+        Returns how many items of the last cycle count towards the arrival rate used by the adaptive scheduler.
+        """
+        return new_items
+
+    def _until_watermark(self, listing, more=None):
+        """
+        Yields the items of a newest first listing until reaching one that was fetched in a previous cycle.
+        The listing is a lazy generator, so no further pages are requested once the watermark is reached.
+        A listing that runs out before the watermark leaves a coverage gap. With catch_up on, more(after, limit)
+        is asked for the listing past the fullname after, to page on towards the watermark right away.
+        """
+        newest = None
+        oldest = None
+        count = 0
+        reached = self.watermark is None
+        last = None
+        yielded = set()
+        while listing is not None:
+            for obj in listing:
+                # base36 ids increase monotonically, so they also work when the watermark item got deleted
+                index = int(obj.id, 36)
+                if self.watermark is not None and index <= self.watermark:
+                    reached = True
+                    break
+                # Listings are only roughly sorted, and a catch-up listing may repeat what was already yielded
+                if index in yielded:
+                    continue
+                yielded.add(index)
+                newest = index if newest is None else max(newest, index)
+                oldest = index if oldest is None else min(oldest, index)
+                last = obj
+                count += 1
+                yield obj
+
+            listing = None
+            if not reached and last is not None and self.catch_up and more is not None:
+                logger.info('Listing for {name} ended before the watermark, paging on from {id}'.format(
+                    name=self.name, id=last.id))
+                listing = more(last.fullname, self.catch_up_limit)
+                more = None
+
+        logger.info('New items since watermark: {count}'.format(count=count))
+        if not reached and oldest is not None:
+            self.__record_gap(count, newest, oldest)
+        elif self.watermark is not None:
+            COVERAGE.set(1.0, handler=self.name)
+        if newest is not None and (self.watermark is None or newest > self.watermark):
+            self.watermark = newest
+
+    def __record_gap(self, count, newest, oldest):
+        # Ids are shared by all of reddit, the listing's share of the ids it spans scales the ids skipped
+        gap = oldest - self.watermark - 1
+        missed = int(round(gap * float(count) / (newest - oldest + 1)))
+        COVERAGE.set(float(count) / (count + missed) if count + missed else 1.0, handler=self.name)
+        MISSED_ITEMS.inc(missed, handler=self.name)
+        logger.warn('Coverage gap for {name}: {gap} ids between the listing and the previous one, '
+                    'about {missed} items missed'.format(name=self.name, gap=gap, missed=missed))
+
     def __is_oauth(self):
         return 'client_id' in self.auth and 'secret' in self.auth
 
@@ -73,7 +296,9 @@ class BotHandler(object):
             logger.error('Could not retrieve access creds: Json error: {status}'.format(status=response['error']))
         else:
             print 'setting access creds for oauth'
-            self.r.set_access_credentials(scope='*', access_token=response['access_token'])
+            self.session.set_access_credentials(scope='*', access_token=response['access_token'])
+            for session in self.worker_sessions:
+                self.__copy_credentials(session, response['access_token'])
             self.expires = time.time() + int(response['expires_in']) * 0.9
 
     def __auth(self):
@@ -81,68 +306,249 @@ class BotHandler(object):
             raise Exception("Must provide username and password in auth")
 
         if self.__is_oauth():
-            self.r.set_oauth_app_info(client_id='a', client_secret='a', redirect_uri='a')
+            self.session.set_oauth_app_info(client_id='a', client_secret='a', redirect_uri='a')
             self.__update_access_credentials()
         else:
-            self.r.login(self.auth['username'], self.auth['password'])
+            self.session.login(self.auth['username'], self.auth['password'])
+
+    def __copy_credentials(self, session, access_token):
+        session.set_access_credentials(scope='*', access_token=access_token, update_user=False)
+        session.user = self.session.user
+
+    def __get_sessions(self):
+        if self.sessions is None:
+            self.sessions = gevent.queue.Queue()
+            for i in xrange(self.concurrency):
+                # praw sessions cannot be shared between greenlets once OAuth is on, so each worker gets its own
+                if self.__is_oauth():
+                    session = self._new_session()
+                    session.set_oauth_app_info(client_id='a', client_secret='a', redirect_uri='a')
+                    self.__copy_credentials(session, self.session.access_token)
+                    self.worker_sessions.append(session)
+                else:
+                    session = self.session
+                self.sessions.put(session)
+        return self.sessions
+
+    def __process(self, obj):
+        """
+        Returns True if the object passed _check, False if not, and None if processing raised.
+        """
+        # Process the object, sandbox exceptions
+        try:
+            start = time.time()
+            valid = self._check(obj)
+            check_time = time.time() - start
+            PHASE_SECONDS.observe(check_time, handler=self.name, phase='check')
+            if not valid:
+                self.item_times.append((check_time, obj.id, check_time, 0.0))
+                return False
+            logger.info('Found valid object: {id} by {name}.'.format(id=obj.id,
+                                                                     name=obj.author.name if obj.author else '[deleted]'))
+            start = time.time()
+            done = self._do(obj)
+            do_time = time.time() - start
+            PHASE_SECONDS.observe(do_time, handler=self.name, phase='do')
+            self.item_times.append((check_time + do_time, obj.id, check_time, do_time))
+            if not done:
+                logger.info('Failed to process object {id}.'.format(id=obj.id))
+            return True
+        except Exception as e:
+            logger.exception('Exception while processing object {id}'.format(id=obj.id))
+            return None
+
+    def __handle(self, obj, results):
+        result = self.__process(obj)
+        results.append(result)
+        ITEMS.inc(handler=self.name, result={True: 'valid', False: 'skipped', None: 'error'}[result])
+
+        # Unordered dedup marks items as they complete, so items that raised are retried next cycle
+        if not self.ordered_dedup and self.cache is not None:
+            if result is not None:
+                self.cache.add(obj.id)
+            else:
+                self.failed_items.append(obj)
+
+    def __handle_in_worker(self, obj, results):
+        sessions = self.__get_sessions()
+        session = sessions.get()
+        self.local.r = session
+        obj.reddit_session = session
+        try:
+            self.__handle(obj, results)
+        finally:
+            self.local.r = None
+            sessions.put(session)
 
     def __main(self):
+        phases = PhaseTimer()
+        self.item_times = []
+        self.failed_items = []
+
         # Check if we need to update access token
         if time.time() > self.expires > 0:
             self.__update_access_credentials()
+        phases.mark('auth')
 
         # Get the content
+        fetch_start = time.time()
         content = self._get_content()
         if not content:
             logger.warn('Bad content object: skipping...')
-            return
+            return 0
 
+        fetched = 0
         hits = 0
         misses = 0
+        results = []
+        in_flight = set()
+        new_items = []
+        listed = []
 
-        # Process all content
+        # Filter out content seen in previous cycles
         for obj in content:
+            fetched += 1
+            if self.capture is not None:
+                listed.append(obj)
+
             # Check if it's in the cache
             if self.cache is not None:
-                if obj.id in self.cache:
+                if obj.id in self.cache or obj.id in in_flight:
                     hits += 1
+                    DEDUP_LOOKUPS.inc(handler=self.name, result='hit')
                     continue
                 misses += 1
-                self.cache[obj.id] = 0
-
-            # Process the object, sandbox exceptions
-            try:
-                if not self._check(obj):
-                    continue
-                logger.info('Found valid object: {id} by {name}.'.format(id=obj.id,
-                                                                         name=obj.author.name if obj.author else '[deleted]'))
-                if not self._do(obj):
-                    logger.info('Failed to process object {id}.'.format(id=obj.id))
-            except Exception as e:
-                logger.exception('Exception while processing object {id}'.format(id=obj.id))
+                DEDUP_LOOKUPS.inc(handler=self.name, result='miss')
+                in_flight.add(obj.id)
+
+            new_items.append(obj)
+
+        # The listing is lazy, so fetching it spans the whole loop
+        PHASE_SECONDS.observe(time.time() - fetch_start, handler=self.name, phase='get_content')
+        phases.mark('get_content')
+
+        # Ordered dedup marks items before they are processed, but only once the whole listing was read:
+        # if a page raises, the items listed so far are listed again next cycle instead of being skipped
+        if self.cache is not None and self.ordered_dedup:
+            for obj in new_items:
+                self.cache.add(obj.id)
+
+        if self.capture is not None:
+            self.capture.record_listing(self.name, listed)
+
+        # Fetch what the new items will look up in bulk
+        self.__prefetch(new_items)
+        phases.mark('prefetch')
+
+        # Process all new content
+        for obj in new_items:
+            if self.pool is None:
+                self.__handle(obj, results)
+            else:
+                self.pool.spawn(self.__handle_in_worker, obj, results)
+
+        if self.pool is not None:
+            self.pool.join()
+        valid = results.count(True)
+        phases.mark('process')
+
+        # The listing already moved the watermark past the items that raised: keep it below them so they are listed
+        # again. Items that keep raising are given up on once the listing no longer reaches them
+        if self.failed_items and self.watermark is not None:
+            oldest = min(int(obj.id, 36) for obj in self.failed_items)
+            if oldest <= self.watermark:
+                self.watermark = oldest - 1
+                logger.info('Keeping the watermark of {name} below {count} items to retry'.format(
+                    name=self.name, count=len(self.failed_items)))
+
+        if self.capture is not None:
+            self.capture.flush()
 
         if self.cache is not None:
+            self.cache.flush()
             logger.info('Cache hits/misses/total: {hits} / {misses} / {total}'.format(hits=hits, misses=misses,
                                                                                       total=hits + misses))
+        phases.mark('flush')
+
+        logger.info('Cycle phases for {name}: {phases}'.format(name=self.name, phases=phases.format()))
+        if self.slow_items and self.item_times:
+            slowest = heapq.nlargest(self.slow_items, self.item_times)
+            logger.info('Slowest items for {name}: {items}'.format(name=self.name, items=', '.join(
+                '{id} {t:.3f}s (check {c:.3f}s, do {d:.3f}s)'.format(id=item_id, t=t, c=c, d=d)
+                for t, item_id, c, d in slowest)))
+
+        return self._activity(fetched - hits, valid)
+
+    def run_once(self):
+        """
+        Runs a single fetch/process cycle and returns the activity it reports to the scheduler.
+        """
+        return self.__main()
+
+    def profile(self, cycles=1):
+        """
+        Profiles the next cycles with cProfile and writes the stats to profile_dir/<name>-<timestamp>.prof.
+        """
+        if cycles < 1:
+            raise ValueError('cycles must be at least 1')
+        self.profiler = CycleProfiler(self.name, cycles, self.profile_dir)
+        logger.info('Profiling the next {cycles} cycles of {name}'.format(cycles=cycles, name=self.name))
+
+    def __run_cycle(self):
+        profiler = self.profiler
+        if profiler is None:
+            return self.run_once()
+
+        # Another handler's cycle being profiled would end up in these stats, so wait for the next cycle
+        if not PROFILE_LOCK.acquire(blocking=False):
+            logger.info('Another cycle is being profiled, not profiling {name} this cycle'.format(name=self.name))
+            return self.run_once()
+        try:
+            return profiler.runcall(self.run_once)
+        finally:
+            PROFILE_LOCK.release()
+            if profiler.done() and profiler is self.profiler:
+                self.profiler = None
+                try:
+                    path = profiler.dump()
+                    logger.info('Profile of {cycles} cycles of {name} written to {path}'.format(
+                        cycles=profiler.cycles, name=self.name, path=path))
+                except Exception as e:
+                    logger.exception('Failed to write the profile of {name}'.format(name=self.name))
 
     def run(self):
         logger.info('Bot started!')
 
+        last_start_time = None
         while True:
-            start_time = time.time()
+            start_time = self.clock.time()
 
+            activity = None
             try:
-                self.__main()
+                with CYCLE_SECONDS.time(handler=self.name):
+                    activity = self.__run_cycle()
             except Exception as e:
+                CYCLE_ERRORS.inc(handler=self.name)
                 logger.exception('Exception while processing content generator')
 
+            # Pick the delay from the arrival rate since the previous poll. A cycle that raised says nothing
+            # about the rate, so it keeps the delay, and the next poll's items count from the previous poll
+            if self.scheduler is not None and activity is not None:
+                if last_start_time is not None:
+                    self.delay = self.scheduler.update(activity, start_time - last_start_time,
+                                                       self.rate_governor.budget())
+                    logger.info('Effective poll interval for {name}: {d:.2f}s ({r:.3f} items/s)'.format(
+                        name=self.name, d=self.delay, r=self.scheduler.rate or 0))
+                last_start_time = start_time
+            POLL_DELAY.set(self.delay, handler=self.name)
+
             # Sleep at least self.delay per cycle
-            time_delta = time.time() - start_time
+            time_delta = self.clock.time() - start_time
             sleep_time = self.delay - time_delta
             logger.info('Processing/Sleeping for: {p:.2f}s / {s:.2f}s'.format(p=time_delta, s=max(0, sleep_time)))
             logger.info('Finished processing round for {name}'.format(name=self.user_agent))
             if sleep_time > 0:
-                time.sleep(sleep_time)
+                self.clock.sleep(sleep_time)
 
         logger.info('Bot finished! Exiting gracefully.')
 
@@ -157,6 +563,10 @@ class UserCommentsVoteTriggeredBot(BotHandler):
 
         super(UserCommentsVoteTriggeredBot, self).__init__(*args, **kwargs)
 
+    def _activity(self, new_items, valid_items):
+        # The whole comment history is listed every cycle, only comments past the thresholds are news
+        return valid_items
+
     def _get_content(self):
         return self.r.get_redditor(self.monitored_user).get_comments(limit=self.fetch_limit)
 
@@ -176,6 +586,10 @@ class MailTriggeredBot(BotHandler):
     def __init__(self, *args, **kwargs):
         super(MailTriggeredBot, self).__init__(*args, **kwargs)
 
+    def _activity(self, new_items, valid_items):
+        # Mail that _check rejects stays unread and is listed again every cycle, only mail acted on is news
+        return valid_items
+
     def _get_content(self):
         return self.r.get_unread(limit=self.fetch_limit)
 
@@ -198,7 +612,10 @@ class SubredditCommentTriggeredBot(BotHandler):
         super(SubredditCommentTriggeredBot, self).__init__(*args, **kwargs)
 
     def _get_content(self):
-        return self.r.get_comments(self.subreddit, limit=self.fetch_limit)
+        return self._until_watermark(self.r.get_comments(self.subreddit, limit=self.fetch_limit), self.__get_older)
+
+    def __get_older(self, after, limit):
+        return self.r.get_comments(self.subreddit, limit=limit, params={'after': after})
 
 
 class SubredditSubmissionTriggeredBot(BotHandler):
@@ -207,4 +624,8 @@ class SubredditSubmissionTriggeredBot(BotHandler):
         super(SubredditSubmissionTriggeredBot, self).__init__(*args, **kwargs)
 
     def _get_content(self):
-        return self.r.get_subreddit(self.subreddit).get_new(limit=self.fetch_limit)
+        return self._until_watermark(self.r.get_subreddit(self.subreddit).get_new(limit=self.fetch_limit),
+                                     self.__get_older)
+
+    def __get_older(self, after, limit):
+        return self.r.get_subreddit(self.subreddit).get_new(limit=limit, params={'after': after})
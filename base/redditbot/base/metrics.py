@@ -0,0 +1,160 @@
+import time
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Registry(object):
+    """
+    The metrics of a process, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) != type(metric) or existing.labelnames != metric.labelnames:
+                raise Exception("Metric {name} is already registered differently".format(name=metric.name))
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise Exception("{name} takes the labels {labels}".format(name=self.name, labels=self.labelnames))
+        return tuple(labels[label] for label in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = zip(self.labelnames, key) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [
+            '# HELP {name} {doc}'.format(name=self.name, doc=self.documentation),
+            '# TYPE {name} {kind}'.format(name=self.name, kind=self.kind),
+        ]
+        for key in sorted(self.values):
+            lines.extend(self._render_value(key, self.values[key]))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['{name}{labels} {value}'.format(name=self.name, labels=self._format_labels(key), value=_number(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Counts observations into cumulative buckets, along with their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # Per bucket counts (the last one is +Inf), then the sum
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def time(self, **labels):
+        """
+        Context manager observing the seconds spent in its block.
+        """
+        return _Timer(self, labels)
+
+    def _render_value(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), state[0]):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else _number(bound)
+            lines.append('{name}_bucket{labels} {value}'.format(
+                name=self.name, labels=self._format_labels(key, [('le', le)]), value=cumulative))
+        labels = self._format_labels(key)
+        lines.append('{name}_sum{labels} {value}'.format(name=self.name, labels=labels, value=_number(state[1])))
+        lines.append('{name}_count{labels} {value}'.format(name=self.name, labels=labels, value=cumulative))
+        return lines
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+def counter(name, documentation, labelnames=(), registry=REGISTRY):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), registry=REGISTRY):
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
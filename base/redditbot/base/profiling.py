@@ -0,0 +1,60 @@
+import os
+import time
+import cProfile
+import logging
+
+from gevent.lock import Semaphore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# cProfile hooks the whole thread, so only one cycle of one handler is profiled at a time
+PROFILE_LOCK = Semaphore()
+
+
+class CycleProfiler(object):
+    """
+    Profiles a number of cycles of a handler with cProfile, then dumps the stats to directory.
+    Greenlets that run while a profiled cycle waits (other handlers, pool workers) show up in the stats too.
+    """
+
+    def __init__(self, name, cycles, directory):
+        self.name = name
+        self.cycles = cycles
+        self.remaining = cycles
+        self.directory = directory
+        self.profile = cProfile.Profile()
+
+    def runcall(self, fn):
+        self.profile.enable()
+        try:
+            return fn()
+        finally:
+            self.profile.disable()
+            self.remaining -= 1
+
+    def done(self):
+        return self.remaining <= 0
+
+    def dump(self):
+        path = os.path.join(self.directory, '{name}-{time}.prof'.format(name=self.name, time=int(time.time())))
+        self.profile.dump_stats(path)
+        return path
+
+
+class PhaseTimer(object):
+    """
+    Splits the time since it was created into consecutive named phases.
+    """
+
+    def __init__(self):
+        self.last = time.time()
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def format(self):
+        return ', '.join('{phase} {t:.2f}s'.format(phase=phase, t=t) for phase, t in self.phases)
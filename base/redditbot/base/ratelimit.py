@@ -0,0 +1,149 @@
+import re
+import time
+import logging
+import urlparse
+
+from gevent.lock import Semaphore
+from praw.handlers import RateLimitHandler
+
+from redditbot.base import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+API_REQUESTS = metrics.counter('redditbot_api_requests_total', 'Requests sent to reddit, by endpoint and status',
+                               ['handler', 'endpoint', 'status'])
+API_SECONDS = metrics.histogram('redditbot_api_request_seconds', 'Latency of requests sent to reddit, by endpoint',
+                                ['handler', 'endpoint'])
+
+# Path parts naming a particular subreddit, user or thing, folded so endpoints stay a small set
+ENDPOINT_PATTERNS = [
+    (re.compile(r'/?(\.json)?/?$'), ''),
+    (re.compile(r'/r/[^/]+'), '/r/{subreddit}'),
+    (re.compile(r'/(u|user)/[^/]+'), '/user/{user}'),
+    (re.compile(r'/comments/[^/]+(/[^/]+(/[^/]+)?)?'), '/comments/{id}'),
+]
+
+# Account name -> RateGovernor
+_governors = {}
+
+
+def get_governor(account, rate):
+    """
+    Returns the RateGovernor for the given account, creating it with the given nominal rate (requests/s) if needed.
+    Every handler logged in as the same account shares one governor.
+    """
+    key = account.lower()
+    governor = _governors.get(key)
+    if governor is None:
+        governor = RateGovernor(rate)
+        _governors[key] = governor
+    return governor
+
+
+class RateGovernor(object):
+    """
+    Token bucket limiting the combined request rate of an account.
+    The refill rate starts at the nominal rate and then follows the X-Ratelimit-Remaining/X-Ratelimit-Reset
+    headers sent back by reddit, spreading what is left of the quota over the rest of the window.
+    """
+
+    def __init__(self, rate, burst=1, max_rate=None):
+        self.nominal_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+        self.max_rate = max_rate
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.remaining = None
+        self.reset_time = None
+        self.lock = Semaphore()
+
+    def _refill(self, now):
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # Requests queue up on the lock, so waiting handlers are served in order
+        with self.lock:
+            self._refill(time.time())
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self._refill(time.time())
+            self.tokens -= 1
+
+    def budget(self):
+        """
+        Returns the fraction of the nominal rate that the remaining quota allows until the window resets, capped at 1.
+        """
+        if self.remaining is None or self.reset_time is None:
+            return 1.0
+
+        seconds_left = self.reset_time - time.time()
+        if seconds_left <= 0:
+            return 1.0
+        return min(1.0, self.remaining / seconds_left / self.nominal_rate)
+
+    def update(self, headers):
+        remaining = headers.get('x-ratelimit-remaining')
+        reset = headers.get('x-ratelimit-reset')
+        if remaining is None or reset is None:
+            return
+
+        try:
+            remaining = float(remaining)
+            reset = max(float(reset), 1.0)
+        except ValueError:
+            return
+
+        self.remaining = remaining
+        self.reset_time = time.time() + reset
+
+        # Quota exhausted: hold everyone until the window resets
+        if remaining < 1:
+            self.tokens = min(self.tokens, 0.0)
+            self.rate = 1.0 / reset
+        else:
+            self.rate = remaining / reset
+        if self.max_rate is not None:
+            self.rate = min(self.rate, self.max_rate)
+
+
+class GovernedHandler(RateLimitHandler):
+    """
+    praw request handler that takes a token from the account's RateGovernor before every request
+    and feeds the rate limit headers of every response back into it.
+    Unlike praw's handlers it does not hold a per-domain lock while the request is in flight,
+    so requests made from several greenlets can overlap.
+    """
+
+    def __init__(self, governor, name=''):
+        super(GovernedHandler, self).__init__()
+        self.governor = governor
+        self.name = name
+
+    def request(self, request, proxies, timeout, verify, **_):
+        self.governor.acquire()
+        endpoint = get_endpoint(request.url)
+        settings = self.http.merge_environment_settings(request.url, proxies, False, verify, None)
+        start_time = time.time()
+        try:
+            response = self.http.send(request, timeout=timeout, allow_redirects=False, **settings)
+        except Exception:
+            API_REQUESTS.inc(handler=self.name, endpoint=endpoint, status='error')
+            raise
+        finally:
+            API_SECONDS.observe(time.time() - start_time, handler=self.name, endpoint=endpoint)
+        API_REQUESTS.inc(handler=self.name, endpoint=endpoint, status=str(response.status_code))
+        self.governor.update(response.headers)
+        return response
+
+
+def get_endpoint(url):
+    """
+    Returns the path of a reddit url with the subreddit, user and thing ids replaced by placeholders.
+    """
+    path = urlparse.urlparse(url).path
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path or '/'
@@ -0,0 +1,248 @@
+import re
+import time
+import bisect
+import logging
+import itertools
+import collections
+
+import praw
+import praw.objects
+
+from redditbot.base.capture import read_capture
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Listings stop after about 1000 items on reddit, whatever the limit
+LISTING_CAP = 1000
+PAGE_SIZE = 100
+
+
+class VirtualClock(object):
+    """
+    Clock starting at start that runs speedup times faster than the real one.
+    Has the time()/sleep() interface BotHandler uses from the time module.
+    """
+
+    def __init__(self, start, speedup=1.0):
+        self.start = start
+        self.speedup = float(speedup)
+        self.real_start = time.time()
+
+    def time(self):
+        return self.start + (time.time() - self.real_start) * self.speedup
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speedup)
+
+
+class ReplayFeed(object):
+    """
+    The things of a capture file, indexed for replay.
+    A handler's listing at a given time holds every thing captured for that handler created by then, newest first,
+    so replays see the same traffic whatever their poll interval is.
+    """
+
+    def __init__(self, records):
+        self.things = {}
+        self.start = None
+        self.end = None
+        listed = collections.defaultdict(dict)
+        for record in records:
+            self.start = record['time'] if self.start is None else min(self.start, record['time'])
+            self.end = record['time'] if self.end is None else max(self.end, record['time'])
+
+            # Later captures of a thing replace earlier ones, scores and edits included
+            for thing in record['things']:
+                fullname = thing['data']['name']
+                self.things[fullname] = thing
+                if record['type'] == 'listing':
+                    listed[record['handler']][fullname] = thing
+
+        self.listings = {}
+        self.created = {}
+        for handler, things in listed.iteritems():
+            things = sorted(things.itervalues(), key=lambda t: t['data'].get('created_utc', 0))
+            self.listings[handler] = things
+            self.created[handler] = [t['data'].get('created_utc', 0) for t in things]
+
+    @classmethod
+    def load(cls, path):
+        return cls(read_capture(path))
+
+    def listing(self, handler, now, limit=None, exclude=()):
+        things = self.listings.get(handler, [])
+        end = bisect.bisect_right(self.created.get(handler, []), now)
+        limit = min(limit or LISTING_CAP, LISTING_CAP)
+
+        listing = []
+        for thing in reversed(things[:end]):
+            if thing['data']['name'] in exclude:
+                continue
+            listing.append(thing)
+            if len(listing) >= limit:
+                break
+        return listing
+
+    def get_thing(self, fullname):
+        return self.things.get(fullname)
+
+
+class ReplayStats(object):
+    """
+    What a replay did: items processed per handler, API calls per method and the latency of every reply sent,
+    measured on the virtual clock from the creation of the thing replied to.
+    """
+
+    def __init__(self):
+        self.items = collections.Counter()
+        self.calls = collections.Counter()
+        self.reply_latencies = []
+        self.started = time.time()
+
+    def report(self):
+        elapsed = time.time() - self.started
+        items = sum(self.items.itervalues())
+        calls = sum(self.calls.itervalues())
+        latencies = sorted(self.reply_latencies)
+        return {
+            'real_seconds': elapsed,
+            'items': items,
+            'items_by_handler': dict(self.items),
+            'items_per_second': items / elapsed if elapsed > 0 else 0.0,
+            'api_calls': calls,
+            'api_calls_by_method': dict(self.calls),
+            'api_calls_per_item': calls / float(items) if items else 0.0,
+            'replies': len(latencies),
+            'reply_latency': {
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'p50': _percentile(latencies, 0.5),
+                'p95': _percentile(latencies, 0.95),
+                'max': latencies[-1] if latencies else None,
+            },
+        }
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class ReplaySession(praw.Reddit):
+    """
+    praw session answering a handler's requests from a ReplayFeed. Things are real praw objects built from the
+    captured json, so type checks behave as they do live. Writes (replies, edits, deletes, marking mail as read)
+    only go as far as the stats.
+    """
+
+    reply_ids = itertools.count(1)
+
+    def __init__(self, user_agent, feed, handler, clock, stats):
+        super(ReplaySession, self).__init__(user_agent, disable_update_check=True, store_json_result='true')
+        self.feed = feed
+        self.handler_name = handler
+        self.clock = clock
+        self.stats = stats
+        self.read_ids = set()
+
+    def login(self, username=None, password=None, **kwargs):
+        self.user = praw.objects.Redditor(self, username)
+
+    def set_oauth_app_info(self, *args, **kwargs):
+        pass
+
+    def set_access_credentials(self, *args, **kwargs):
+        pass
+
+    def is_logged_in(self):
+        return True
+
+    def get_content(self, url, params=None, limit=0, *args, **kwargs):
+        # Every listing of a handler is the handler's captured feed
+        things = self.feed.listing(self.handler_name, self.clock.time(), limit, exclude=self.read_ids)
+        self.stats.calls['listing'] += max(1, -(-len(things) // PAGE_SIZE))
+        return (self._build(thing) for thing in things)
+
+    def get_info(self, url=None, thing_id=None, *args, **kwargs):
+        if isinstance(thing_id, list):
+            self.stats.calls['get_info'] += -(-len(thing_id) // PAGE_SIZE)
+            things = (self.feed.get_thing(t) for t in thing_id)
+            return [self._build(thing) for thing in things if thing is not None]
+
+        self.stats.calls['get_info'] += 1
+        thing = self.feed.get_thing(thing_id)
+        return self._build(thing) if thing is not None else None
+
+    def get_submission(self, url=None, submission_id=None, *args, **kwargs):
+        self.stats.calls['get_submission'] += 1
+        if submission_id is None:
+            submission_id = re.search('/comments/([^/]+)', url).group(1)
+        thing = self.feed.get_thing('t3_' + submission_id)
+        if thing is not None:
+            return self._build(thing)
+        return praw.objects.Submission.from_api_response(self, {
+            'id': submission_id,
+            'name': 't3_' + submission_id,
+            'permalink': '/comments/{id}/_/'.format(id=submission_id),
+        })
+
+    def request_json(self, url, params=None, data=None, *args, **kwargs):
+        # Comment pages (when replies are verified) come back empty, replies are only known from the ledger
+        if '/comments/' in url:
+            self.stats.calls['comments'] += 1
+            return [{'data': {'children': []}}, {'data': {'children': []}}]
+
+        # Edits and deletes, the only other requests the handlers make
+        self.stats.calls[url.rstrip('/').rsplit('/', 1)[-1]] += 1
+        return {'data': {'things': [None]}}
+
+    def _add_comment(self, thing_id, text):
+        self.stats.calls['comment'] += 1
+        now = self.clock.time()
+        parent = self.feed.get_thing(thing_id) or {'data': {}}
+        created = parent['data'].get('created_utc')
+        if created is not None:
+            self.stats.reply_latencies.append(now - created)
+
+        reply_id = 'replay{n}'.format(n=next(self.reply_ids))
+        return praw.objects.Comment.from_api_response(self, {
+            'id': reply_id,
+            'name': 't1_' + reply_id,
+            'body': text,
+            'author': self.user.name if self.user else None,
+            'parent_id': thing_id,
+            'link_id': parent['data'].get('link_id', thing_id),
+            'subreddit': parent['data'].get('subreddit'),
+            'created_utc': now,
+            'replies': '',
+        })
+
+    def _mark_as_read(self, thing_ids, unread=False):
+        self.stats.calls['read_message'] += 1
+        if unread:
+            self.read_ids.difference_update(thing_ids)
+        else:
+            self.read_ids.update(thing_ids)
+
+    def _build(self, thing):
+        return self.config.by_kind[thing['kind']].from_api_response(self, dict(thing['data']))
+
+
+class ReplayMixin(object):
+    """
+    Mixed in front of a BotHandler subclass to run it against a ReplayFeed instead of reddit.
+    Pass feed and stats, and a VirtualClock as the handler's clock.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.feed = kwargs.pop('feed')
+        self.stats = kwargs.pop('stats')
+        super(ReplayMixin, self).__init__(*args, **kwargs)
+
+    def _new_session(self):
+        return ReplaySession(self.user_agent, self.feed, self.name, self.clock, self.stats)
+
+    def _check(self, obj):
+        self.stats.items[self.name] += 1
+        return super(ReplayMixin, self)._check(obj)
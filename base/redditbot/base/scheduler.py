@@ -0,0 +1,37 @@
+class AdaptivePollScheduler(object):
+    """
+    Picks the delay before a handler's next poll from the rate new items arrive at.
+    The delay aims for target_items new items per poll, so busy feeds are polled before they overflow the listing
+    window and idle feeds back off towards max_delay. It is stretched further when the account's rate budget runs low.
+    """
+
+    def __init__(self, delay, min_delay, max_delay, target_items=50, smoothing=0.3):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_items = target_items
+        self.smoothing = smoothing
+        self.delay = min(max(delay, min_delay), max_delay)
+        self.rate = None
+
+    def update(self, new_items, elapsed, budget=1.0):
+        """
+        Records new_items seen over the last elapsed seconds and returns the delay before the next poll.
+        budget is the fraction of the nominal request rate still available to the account.
+        """
+        if elapsed > 0:
+            sample = new_items / float(elapsed)
+            if self.rate is None:
+                self.rate = sample
+            else:
+                self.rate = self.smoothing * sample + (1 - self.smoothing) * self.rate
+
+        if self.rate:
+            delay = self.target_items / self.rate
+        else:
+            delay = self.max_delay
+
+        if budget < 1.0:
+            delay /= max(budget, 0.1)
+
+        self.delay = min(max(delay, self.min_delay), self.max_delay)
+        return self.delay
@@ -7,12 +7,20 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def has_replied(praw_object, username):
+def has_replied(praw_object, username, ledger=None, verify=True):
     """
     Returns True if the specified user has a comment in the top level replies of the given submission/comment/message,
     and False otherwise.
+    If a reply ledger is given (any object with has_reply(parent_fullname)), it is checked first, and the replies are
+    only fetched from reddit when verify is True.
     For comments, submissions, messages ONLY.
     """
+    if ledger is not None:
+        if ledger.has_reply(praw_object.fullname):
+            return True
+        if not verify:
+            return False
+
     if type(praw_object) == praw.objects.Message:
         # TODO: Fix this to actually check properly
         # If it's not the first message in the PM thread, we replied previously.
@@ -49,9 +57,10 @@ def is_comment_owner(praw_comment, username):
     return praw_comment.author and praw_comment.author.name.lower() == username.lower()
 
 
-def send_reply(praw_object, reply_msg):
+def send_reply(praw_object, reply_msg, ledger=None):
     """
     Returns the reply object if the message was sent successfully, otherwise None.
+    If a reply ledger is given (any object with add_reply(parent_fullname, reply_fullname)), the reply is recorded in it.
     For comments, submissions, messages ONLY.
     """
     try:
@@ -70,6 +79,8 @@ def send_reply(praw_object, reply_msg):
         return None
 
     logger.info(' => Reply Sent!')
+    if ledger is not None and reply_obj is not None:
+        ledger.add_reply(praw_object.fullname, reply_obj.fullname)
     return reply_obj
 
 
@@ -88,14 +99,21 @@ def edit_reply(praw_comment, reply_msg):
     return True
 
 
-def has_chain(praw_r, praw_comment, username):
+def has_chain(praw_r, praw_comment, username, things=None):
     """
     Returns True if the parent was made by username.
     Returns False otherwise.
+    things is an optional dict of prefetched fullname -> thing (None if it does not exist) checked before reddit.
     """
     if not hasattr(praw_comment, 'parent_id'):
         return False
-    parent = praw_r.get_info(thing_id=praw_comment.parent_id)
+    # Only a comment can be the parent in a chain
+    if not praw_comment.parent_id.startswith('t1_'):
+        return False
+    if things is not None and praw_comment.parent_id in things:
+        parent = things[praw_comment.parent_id]
+    else:
+        parent = praw_r.get_info(thing_id=praw_comment.parent_id)
     if not parent or type(parent) != praw.objects.Comment:
         return False
     return is_comment_owner(parent, username)
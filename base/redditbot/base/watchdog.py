@@ -0,0 +1,151 @@
+import sys
+import time
+import logging
+import traceback
+
+import gevent
+import greenlet
+from gevent import monkey
+
+from redditbot.base import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+HUB_LATENCY = metrics.histogram('redditbot_hub_latency_seconds', 'How late the watchdog heartbeat was woken by the hub',
+                                buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+HUB_BLOCKS = metrics.counter('redditbot_hub_blocks_total', 'Times a greenlet blocked the hub past the threshold',
+                             ['greenlet'])
+HUB_BLOCKED_SECONDS = metrics.counter('redditbot_hub_blocked_seconds_total',
+                                      'Seconds the hub was blocked past the threshold, by blocking greenlet',
+                                      ['greenlet'])
+
+
+class HubWatchdog(object):
+    """
+    Finds what blocks the gevent hub, which delays every greenlet (and so every handler) of the process.
+    A heartbeat greenlet measures how late the hub wakes it up. A native thread, which keeps running while the hub
+    is blocked, grabs the stack of the blocking greenlet when the heartbeat is more than threshold seconds late.
+    Blocks are aggregated by greenlet and code location, and the top offenders are logged every report_interval.
+    """
+
+    def __init__(self, threshold=0.5, interval=0.1, report_interval=600, top=5):
+        self.threshold = threshold
+        self.interval = interval
+        self.report_interval = report_interval
+        self.top = top
+        self.current = None
+        self.last_beat = None
+        self.pending = None
+        self.offenders = {}
+        self.running = False
+        self.heartbeat = None
+        self.hub_thread = None
+        self.previous_trace = None
+
+    def start(self):
+        self.running = True
+        self.hub_thread = monkey.get_original('thread', 'get_ident')()
+        self.last_beat = time.time()
+        self.previous_trace = greenlet.settrace(self._trace)
+        self.heartbeat = gevent.spawn(self._beat)
+        monkey.get_original('thread', 'start_new_thread')(self._monitor, ())
+        logger.info('Hub watchdog started, reporting blocks over {t:.2f}s'.format(t=self.threshold))
+
+    def stop(self):
+        self.running = False
+        greenlet.settrace(self.previous_trace)
+        if self.heartbeat is not None:
+            self.heartbeat.kill()
+
+    def report(self):
+        """
+        Returns the top offenders since the last report, slowest first.
+        """
+        offenders = sorted(self.offenders.itervalues(), key=lambda o: o['seconds'], reverse=True)[:self.top]
+        if not offenders:
+            return 'No blocks over {t:.2f}s\n'.format(t=self.threshold)
+        lines = []
+        for offender in offenders:
+            lines.append('{count} blocks, {seconds:.2f}s (max {max:.2f}s) in {who} at {where}'.format(**offender))
+            lines.append(offender['stack'])
+        return '\n'.join(lines)
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            self.current = args[1]
+        if self.previous_trace is not None:
+            self.previous_trace(event, args)
+
+    def _beat(self):
+        last_report = time.time()
+        while self.running:
+            start = time.time()
+            gevent.sleep(self.interval)
+            self.last_beat = time.time()
+            latency = max(0, self.last_beat - start - self.interval)
+            HUB_LATENCY.observe(latency)
+
+            # The monitor thread saw the block happen, now that it is over its length is known
+            pending = self.pending
+            self.pending = None
+            if pending is not None and latency > self.threshold:
+                self._record(pending, latency)
+
+            if self.last_beat - last_report >= self.report_interval:
+                if self.offenders:
+                    logger.warn('Top hub blocking offenders over the last {s:.0f}s:\n{report}'.format(
+                        s=self.last_beat - last_report, report=self.report()))
+                self.offenders = {}
+                last_report = self.last_beat
+
+    def _monitor(self):
+        # Runs in a native thread: only sleep from the original time module, and keep away from gevent
+        sleep = monkey.get_original('time', 'sleep')
+        seen_beat = None
+        while self.running:
+            sleep(self.interval)
+            last_beat = self.last_beat
+            if last_beat == seen_beat or time.time() - last_beat < self.interval + self.threshold:
+                continue
+
+            # Capture once per block, while the blocking code is still on the stack
+            seen_beat = last_beat
+            frame = sys._current_frames().get(self.hub_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            self.pending = (_describe(self.current), stack)
+
+    def _record(self, pending, seconds):
+        who, stack = pending
+        where = '{0}:{1} in {2}'.format(*stack[-1][:3]) if stack else 'unknown'
+        offender = self.offenders.get((who, where))
+        if offender is None:
+            offender = self.offenders[(who, where)] = {
+                'who': who, 'where': where, 'count': 0, 'seconds': 0.0, 'max': 0.0,
+                'stack': ''.join(traceback.format_list(stack[-8:])).rstrip(),
+            }
+        offender['count'] += 1
+        offender['seconds'] += seconds
+        offender['max'] = max(offender['max'], seconds)
+        HUB_BLOCKS.inc(greenlet=who)
+        HUB_BLOCKED_SECONDS.inc(seconds, greenlet=who)
+        logger.warn('Hub blocked for {s:.2f}s by {who} at {where}'.format(s=seconds, who=who, where=where))
+
+
+def _describe(glet):
+    """
+    Names a greenlet after the handler it runs for (handler loops and pool workers), or after its function.
+    """
+    if glet is None:
+        return 'unknown'
+    run = getattr(glet, '_run', None)
+    owner = getattr(run, '__self__', None)
+    if getattr(owner, 'name', None):
+        return owner.name
+    if run is not None:
+        return getattr(run, '__name__', type(run).__name__)
+    if isinstance(glet, gevent.hub.Hub):
+        return 'hub'
+    return 'main' if glet.parent is None else type(glet).__name__
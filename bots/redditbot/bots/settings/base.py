@@ -14,5 +14,12 @@ REDDIT_ACCOUNTS = {
 AUTHOR = '/u/name_here'
 
 XKCD_DB_LOCATION = '/path/to/db'
+XKCD_SEEN_DB_LOCATION = '/path/to/seen_db'
+XKCD_HTTP_CACHE_LOCATION = '/path/to/http_cache'
+# Set to a file path to record what the xkcd bots fetch, for replay-xkcdref
+XKCD_CAPTURE_LOCATION = ''
 
 DRY_RUN = False
+
+# Local port serving /metrics and the other admin endpoints, None to disable
+ADMIN_PORT = 9105
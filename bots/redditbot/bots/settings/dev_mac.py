@@ -1,2 +1,4 @@
 XKCD_DB_LOCATION = ''
+XKCD_SEEN_DB_LOCATION = ''
+XKCD_HTTP_CACHE_LOCATION = ''
 DRY_RUN = True
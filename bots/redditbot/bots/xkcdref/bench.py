@@ -0,0 +1,301 @@
+import os
+import sys
+import time
+import shutil
+import timeit
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import itertools
+
+import simplejson
+
+from redditbot.base.dedup import LruDedup
+from redditbot.base.fakes import FakeComment, FakeReddit
+from redditbot.base.handlers import BotHandler
+from redditbot.base.ratelimit import RateGovernor
+from bot import CommentXkcdBot, ReferenceBuilder
+from datastore import BotDataStore
+from links import extract_links, snudown, snudown_links
+from xkcdfetcher import XkcdFetcher
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+COMIC_COUNT = 2000
+
+# Results the suite is held to unless told otherwise, recorded with --output on the machine that runs the check
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+AUTH = {'username': 'xkcd_transcriber', 'password': 'x'}
+
+FILLER = [
+    u'I think this is the wrong way to look at it.',
+    u'Source? [citation needed](https://en.wikipedia.org/wiki/Wikipedia:Citation_needed)',
+    u'> quoting the parent here\n\nand a *reply* with `code` in it.',
+    u'Came here to say this. https://www.reddit.com/r/AskReddit/comments/abc/',
+]
+
+# (name, function(fixture) returning (callable, calls per timing)), in run order
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return decorator
+
+
+class FakeHttpClient(object):
+    def get(self, url):
+        return None
+
+
+class DedupBot(BotHandler):
+    """
+    Handler that lists a sliding window of comments and rejects them all, so a cycle only runs the dedup loop.
+    """
+
+    def __init__(self, comments, window, step, *args, **kwargs):
+        self.comments = comments
+        self.window = window
+        self.starts = itertools.cycle(xrange(0, len(comments) - window, step))
+        super(DedupBot, self).__init__(*args, **kwargs)
+
+    def _new_session(self):
+        return FakeReddit()
+
+    def _get_content(self):
+        start = next(self.starts)
+        return self.comments[start:start + self.window]
+
+    def _check(self, obj):
+        return False
+
+
+class BenchCommentBot(CommentXkcdBot):
+    def _new_session(self):
+        return FakeReddit()
+
+
+class Fixture(object):
+    """
+    Everything the benchmarks share: a datastore in a temporary directory, a fetcher with every comic indexed
+    and a set of comments, about one in ten referencing a comic.
+    """
+
+    def __init__(self):
+        self.rand = random.Random(0)
+        self.path = tempfile.mkdtemp(prefix='xkcdref-bench-')
+        self.datastore = BotDataStore('xkcd_transcriber', self.path + '/xkcd.db', batch_size=500)
+
+        self.fetcher = XkcdFetcher(self.datastore, http_client=FakeHttpClient())
+        for comic_id in xrange(1, COMIC_COUNT + 1):
+            self.fetcher._index_meta(comic_id, {'json_data': self._comic_json(comic_id), 'hash_avg': None})
+        self.fetcher.next_index = COMIC_COUNT + 1
+
+        # Skewed towards popular comics, like real traffic
+        for i in xrange(20000):
+            comic_id = min(int(self.rand.paretovariate(1.2)), COMIC_COUNT)
+            self.datastore.insert_xkcd_event(comic_id, i, 'all', 'user%d' % i, 'https://redd.it/%d' % i, False)
+        self.datastore.flush()
+
+        self.comments = [self._comment(i) for i in xrange(5000)]
+        self.xkcd_comments = [c for c in self.comments if 'xkcd.com' in c.body]
+        self.bot = BenchCommentBot(user_agent='xkcdref bench', auth=AUTH, delay=0, fetch_limit=None, dry_run=True,
+                                   rate_governor=RateGovernor(1000), subreddit='all', datastore=self.datastore,
+                                   xkcd_fetcher=self.fetcher)
+        # Benchmark the steady state, where the reply ledger is trusted without asking reddit
+        self.bot.ledger_cold = False
+
+    def close(self):
+        self.datastore.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _comic_json(self, comic_id):
+        return {
+            'num': comic_id,
+            'title': u'Comic number %d' % comic_id,
+            'img': u'https://imgs.xkcd.com/comics/comic_%d.png' % comic_id,
+            'alt': u"The alt-text of comic %d, with *markdown* characters (and a [link]) to escape." % comic_id,
+            'transcript': u'[[A person stands at a whiteboard.]]\nPerson: Line %d.\n{{Title text: alt}}' % comic_id,
+            'link': u'',
+        }
+
+    def _comment(self, i):
+        body = self.rand.choice(FILLER)
+        if i % 10 == 0:
+            comic_id = self.rand.randint(1, COMIC_COUNT)
+            body += self.rand.choice([
+                u'\n\nRelevant xkcd: https://xkcd.com/%d/' % comic_id,
+                u' Obligatory [xkcd](http://xkcd.com/%d).' % comic_id,
+                u'\n\nhttps://imgs.xkcd.com/comics/comic_%d.png' % comic_id,
+            ])
+        parent_id = 't1_p%d' % i if i % 3 else 't3_s%d' % i
+        return FakeComment(str(i), body, subreddit='pics', author='user%d' % i, parent_id=parent_id)
+
+
+@benchmark('comment_check')
+def bench_check(fixture):
+    comments = itertools.cycle(fixture.comments)
+    bot = fixture.bot
+    return lambda: bot._check(next(comments)), 5000
+
+
+@benchmark('extract_links')
+def bench_extract_links(fixture):
+    bodies = itertools.cycle([c.body for c in fixture.xkcd_comments])
+    return lambda: extract_links(next(bodies)), 5000
+
+
+@benchmark('extract_links_snudown')
+def bench_extract_links_snudown(fixture):
+    # The rendering path extract_links replaced, for comparison when snudown and beautifulsoup4 are installed
+    if snudown is None:
+        return None
+    bodies = itertools.cycle([c.body for c in fixture.xkcd_comments])
+    return lambda: snudown_links(next(bodies)), 1000
+
+
+@benchmark('comment_do')
+def bench_do(fixture):
+    comments = itertools.cycle(fixture.xkcd_comments)
+    bot = fixture.bot
+    return lambda: bot._do(next(comments)), 500
+
+
+@benchmark('fetcher_get_json')
+def bench_get_json(fixture):
+    urls = []
+    for comic_id in xrange(1, COMIC_COUNT + 1, 7):
+        urls.append('https://xkcd.com/%d/' % comic_id)
+        urls.append('http://imgs.xkcd.com/comics/comic_%d.png' % comic_id)
+    # Unknown image, served from the negative cache after the first lookup
+    urls.append('https://imgs.xkcd.com/comics/not_a_comic.png')
+    urls = itertools.cycle(urls)
+    fetcher = fixture.fetcher
+    return lambda: fetcher.get_json(next(urls)), 10000
+
+
+@benchmark('reference_build_all')
+def bench_build_all(fixture):
+    comments = itertools.cycle(fixture.xkcd_comments)
+    comic_ids = itertools.cycle(xrange(1, 50))
+
+    def build():
+        comic_id = next(comic_ids)
+        refs = {comic_id: {'data': fixture.fetcher.json_index[comic_id], 'href': 'https://xkcd.com/%d/' % comic_id}}
+        ReferenceBuilder(include_transcript=True).build_all(next(comments), refs, fixture.fetcher, fixture.datastore,
+                                                            None)
+    return build, 2000
+
+
+@benchmark('datastore_get_stats')
+def bench_get_stats(fixture):
+    comic_ids = itertools.cycle(xrange(1, COMIC_COUNT + 1))
+    datastore = fixture.datastore
+    return lambda: datastore.get_stats(next(comic_ids)), 5000
+
+
+@benchmark('datastore_insert_xkcd_event')
+def bench_insert_event(fixture):
+    # Unique links, so every row is a real insert; the batch flushes every 500 rows
+    counter = itertools.count(100000)
+    datastore = fixture.datastore
+
+    def insert():
+        i = next(counter)
+        datastore.insert_xkcd_event(i % COMIC_COUNT + 1, i, 'all', 'user', 'https://redd.it/%d' % i, False)
+    return insert, 5000
+
+
+@benchmark('handler_dedup_cycle')
+def bench_dedup_cycle(fixture):
+    # 100 item listings that overlap the previous cycle by half
+    bot = DedupBot(fixture.comments, 100, 50, user_agent='dedup bench', auth=AUTH, delay=0, fetch_limit=None,
+                   rate_governor=RateGovernor(1000), dedup=LruDedup(2000))
+    return bot.run_once, 200
+
+
+def run_benchmarks(repeat=5, name_filter=None):
+    """
+    Runs every benchmark (or those whose name contains name_filter) and returns name -> result,
+    keeping the best of repeat timings.
+    """
+    fixture = Fixture()
+    results = {}
+    try:
+        for name, setup in BENCHMARKS:
+            if name_filter and name_filter not in name:
+                continue
+            bench = setup(fixture)
+            if bench is None:
+                logger.info('{name}: skipped'.format(name=name))
+                continue
+            fn, number = bench
+            fn()
+            best = min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+            results[name] = {'us_per_call': best * 1e6, 'calls': number}
+            logger.info('{name}: {t:.2f}us per call'.format(name=name, t=best * 1e6))
+    finally:
+        fixture.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the names of the benchmarks more than tolerance (a fraction) slower than in the baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        limit = baseline[name]['us_per_call'] * (1 + tolerance)
+        if result['us_per_call'] > limit:
+            regressions.append(name)
+            logger.error('{name} regressed: {t:.2f}us per call, baseline {b:.2f}us'.format(
+                name=name, t=result['us_per_call'], b=baseline[name]['us_per_call']))
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the xkcdref per-item path')
+    parser.add_argument('--output', help='Write the results as json to this file')
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help='Fail if results are slower than the ones in this json file (bench_baseline.json)')
+    parser.add_argument('--no-baseline', action='store_true', help='Only report the results')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', help='Only run benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s')
+    # Keep the bots' own per-item logging out of the timings
+    logging.disable(logging.WARNING)
+    try:
+        results = run_benchmarks(args.repeat, args.filter)
+    finally:
+        logging.disable(logging.NOTSET)
+    for name, result in sorted(results.iteritems()):
+        print '{name:<32} {t:>10.2f} us'.format(name=name, t=result['us_per_call'])
+
+    report = {
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            simplejson.dump(report, f, indent=2, sort_keys=True)
+
+    if not args.no_baseline:
+        with open(args.baseline) as f:
+            baseline = simplejson.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
@@ -4,12 +4,12 @@ import logging
 import random
 
 import praw
-import snudown
-from bs4 import BeautifulSoup
+import pylru
 
 from redditbot.base import utils
 from redditbot.base.handlers import MailTriggeredBot, UserCommentsVoteTriggeredBot, SubredditCommentTriggeredBot, \
     SubredditSubmissionTriggeredBot
+from links import extract_links
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -67,6 +67,7 @@ XKCD_SIG_LINKS = [
 ]
 
 MARKDOWN_ESCAPE_CHARACTERS = "\\`*_{}[]()#+-.!:|&<>/^~"
+MARKDOWN_ESCAPE_REGEX = re.compile('([' + re.escape(MARKDOWN_ESCAPE_CHARACTERS) + '])')
 
 
 class MailXkcdBot(MailTriggeredBot):
@@ -76,12 +77,23 @@ class MailXkcdBot(MailTriggeredBot):
         super(MailXkcdBot, self).__init__(*args, **kwargs)
 
     def _check(self, mail):
-        if utils.has_replied(mail, self.auth['username']):
+        if utils.has_replied(mail, self.auth['username'], ledger=self.datastore):
             return False
         if utils.is_comment_owner(mail, self.auth['username']):
             return False
         return True
 
+    def _get_prefetch_ids(self, mail):
+        # Parents of comment replies, and the comments named in delete requests along with their parents
+        if self.is_comment_reply(mail):
+            return [mail.parent_id]
+        if self.is_private_message(mail):
+            parts = mail.body.split(' ')
+            if mail.body.lower().startswith('delete') and len(parts) == 2 and parts[1].startswith('t1_'):
+                target = self.things.get(parts[1])
+                return [parts[1], target.parent_id] if target is not None else [parts[1]]
+        return []
+
     def _do(self, mail):
         body_lower = mail.body.lower()
         subject_lower = mail.subject.lower()
@@ -121,9 +133,9 @@ class MailXkcdBot(MailTriggeredBot):
         parts = mail.body.split(' ')
         if len(parts) == 2:
             thing_id = parts[1]
-            obj = self.r.get_info(thing_id=thing_id)
+            obj = self.get_thing(thing_id)
             if obj:
-                parent = self.r.get_info(thing_id=obj.parent_id)
+                parent = self.get_thing(obj.parent_id)
                 if parent and parent.author and parent.author.name == mail.author.name:
                     if not self.dry_run:
                         obj.delete()
@@ -147,12 +159,12 @@ class MailXkcdBot(MailTriggeredBot):
             return True
 
         # Do not reply if the user is ignored
-        if mail.author and mail.author.name.lower() in self.datastore.get_ignores():
+        if mail.author and self.datastore.is_ignored(mail.author.name):
             logger.info('Skipping mail {id}. Reason: Author on ignore list.'.format(id=mail.id))
             return True
 
         # Check it was originally a reply to a transcript
-        if not self._is_transcript_reply(self.r, mail, self.auth['username']):
+        if not self._is_transcript_reply(mail, self.auth['username']):
             logger.info('Skipping to post joke reply to {id}. Reason: Not a reply to a transcript'.format(id=mail.id))
             return True
 
@@ -161,15 +173,15 @@ class MailXkcdBot(MailTriggeredBot):
             return True
 
         # Reply to the user
-        if utils.send_reply(mail, reply_msg):
+        if utils.send_reply(mail, reply_msg, ledger=self.datastore):
             return True
         return False
 
-    def _is_transcript_reply(self, praw_r, praw_comment, username):
+    def _is_transcript_reply(self, praw_comment, username):
         if not hasattr(praw_comment, 'parent_id'):
             return False
 
-        parent = praw_r.get_info(thing_id=praw_comment.parent_id)
+        parent = self.get_thing(praw_comment.parent_id)
         if not parent or type(parent) != praw.objects.Comment:
             return False
         return len(parent.body) > 50 and utils.is_comment_owner(parent, username)
@@ -187,8 +199,18 @@ class CommentXkcdBot(SubredditCommentTriggeredBot):
     def __init__(self, *args, **kwargs):
         self.datastore = kwargs.pop('datastore')
         self.xkcd_fetcher = kwargs.pop('xkcd_fetcher')
+        self.verify_replies = kwargs.pop('verify_replies', False)
         super(CommentXkcdBot, self).__init__(*args, **kwargs)
 
+        # Replies sent before the ledger was kept are only known to reddit. They can only show up in the first
+        # listing (later ones stop at its watermark), so the first cycle verifies over the network
+        self.ledger_cold = not self.datastore.has_replies()
+
+    def run_once(self):
+        activity = super(CommentXkcdBot, self).run_once()
+        self.ledger_cold = False
+        return activity
+
     def _check(self, comment):
         if comment.body.lower().find('xkcd.com') == -1:
             return False
@@ -198,20 +220,22 @@ class CommentXkcdBot(SubredditCommentTriggeredBot):
             return False
         if utils.is_comment_owner(comment, self.auth['username']):
             return False
-        if utils.has_replied(comment, self.auth['username']):
+        if utils.has_replied(comment, self.auth['username'], ledger=self.datastore,
+                             verify=self.verify_replies or self.ledger_cold):
             return False
-        return not utils.has_chain(self.r, comment, self.auth['username'])
+        return not utils.has_chain(self.r, comment, self.auth['username'], things=self.things)
+
+    def _get_prefetch_ids(self, comment):
+        # Only comments that reach has_chain in _check need their parent
+        if comment.body.lower().find('xkcd.com') == -1 or not comment.parent_id.startswith('t1_'):
+            return []
+        return [comment.parent_id]
 
     def _do(self, comment):
-        html = snudown.markdown(comment.body.encode('UTF-8'))
-        soup = BeautifulSoup(html)
         refs = {}
 
         # Iterate through all links, get xkcd json
-        for link in soup.find_all('a'):
-            href = link.get('href')
-            if not href:
-                continue
+        for href in extract_links(comment.body):
             j = self.xkcd_fetcher.get_json(href)
             if not j:
                 logger.warn('Data could not be fetched for {url}'.format(url=href))
@@ -237,8 +261,11 @@ class CommentXkcdBot(SubredditCommentTriggeredBot):
                 self.datastore.insert_xkcd_event(comic_id, timestamp, sub, author, link,
                                                  ref['data'].get('from_external', False))
 
+        # The stats in the reply must include these references
+        self.datastore.flush()
+
         # Do not reply if the user is ignored
-        if comment.author and comment.author.name.lower() in self.datastore.get_ignores():
+        if comment.author and self.datastore.is_ignored(comment.author.name):
             logger.info('Skipping comment {id}. Reason: Author on ignore list.'.format(id=comment.id))
             return True
 
@@ -257,7 +284,7 @@ class CommentXkcdBot(SubredditCommentTriggeredBot):
             return True
 
         # Reply to the user
-        reply_obj = utils.send_reply(comment, reply_msg)
+        reply_obj = utils.send_reply(comment, reply_msg, ledger=self.datastore)
         if reply_obj is None:
             return False
 
@@ -274,8 +301,18 @@ class SubmissionXkcdBot(SubredditSubmissionTriggeredBot):
     def __init__(self, *args, **kwargs):
         self.datastore = kwargs.pop('datastore')
         self.xkcd_fetcher = kwargs.pop('xkcd_fetcher')
+        self.verify_replies = kwargs.pop('verify_replies', False)
         super(SubmissionXkcdBot, self).__init__(*args, **kwargs)
 
+        # Replies sent before the ledger was kept are only known to reddit. They can only show up in the first
+        # listing (later ones stop at its watermark), so the first cycle verifies over the network
+        self.ledger_cold = not self.datastore.has_replies()
+
+    def run_once(self):
+        activity = super(SubmissionXkcdBot, self).run_once()
+        self.ledger_cold = False
+        return activity
+
     def _check(self, submission):
         if submission.is_self:
             if submission.selftext.lower().find('xkcd.com') == -1:
@@ -289,7 +326,8 @@ class SubmissionXkcdBot(SubredditSubmissionTriggeredBot):
             return False
         if utils.is_comment_owner(submission, self.auth['username']):
             return False
-        if utils.has_replied(submission, self.auth['username']):
+        if utils.has_replied(submission, self.auth['username'], ledger=self.datastore,
+                             verify=self.verify_replies or self.ledger_cold):
             return False
         return not utils.has_chain(self.r, submission, self.auth['username'])
 
@@ -300,15 +338,10 @@ class SubmissionXkcdBot(SubredditSubmissionTriggeredBot):
             return self.process_link(submission)
 
     def process_self(self, submission):
-        html = snudown.markdown(submission.selftext.encode('UTF-8'))
-        soup = BeautifulSoup(html)
         refs = {}
 
         # Iterate through all links, get xkcd json
-        for link in soup.find_all('a'):
-            href = link.get('href')
-            if not href:
-                continue
+        for href in extract_links(submission.selftext):
             j = self.xkcd_fetcher.get_json(href)
             if not j:
                 logger.warn('Data could not be fetched for {url}'.format(url=href))
@@ -349,8 +382,11 @@ class SubmissionXkcdBot(SubredditSubmissionTriggeredBot):
                 self.datastore.insert_xkcd_event(comic_id, timestamp, sub, author, link,
                                                  ref['data'].get('from_external', False))
 
+        # The stats in the reply must include these references
+        self.datastore.flush()
+
         # Do not reply if the user is ignored
-        if submission.author and submission.author.name.lower() in self.datastore.get_ignores():
+        if submission.author and self.datastore.is_ignored(submission.author.name):
             logger.info('Skipping submission {id}. Reason: Author on ignore list.'.format(id=submission.id))
             return True
 
@@ -370,7 +406,7 @@ class SubmissionXkcdBot(SubredditSubmissionTriggeredBot):
             return True
 
         # Reply to the user
-        reply_obj = utils.send_reply(submission, reply_msg)
+        reply_obj = utils.send_reply(submission, reply_msg, ledger=self.datastore)
         if reply_obj is None:
             return False
 
@@ -384,6 +420,9 @@ class SubmissionXkcdBot(SubredditSubmissionTriggeredBot):
 
 
 class ReferenceBuilder(object):
+    # (comic_id, include_transcript, from_source) -> (json, rendered fragment), shared by every builder
+    fragment_cache = pylru.lrucache(4096)
+
     def __init__(self, include_transcript=False):
         self.include_transcript = include_transcript
         self.reply_msg_head = ''
@@ -423,38 +462,56 @@ class ReferenceBuilder(object):
                 thing_id=reply_obj.name)
 
     def build_body(self, refs, xkcd_fetcher, datastore):
-        # Reset
-        self.reply_msg_body = ''
-
-        # Build body text
+        parts = []
         for comic_id, ref in refs.iteritems():
-            data = ref['data']
-            if self.reply_msg_body != '':
-                self.reply_msg_body += u'----\n'
-
-            if ref['href'].find('imgs.xkcd.com') != -1 or data.get('from_external') is True:
-                self.reply_msg_body += u'[Original Source](https://xkcd.com/{num}/)\n\n'.format(num=comic_id)
-            elif data.get('img'):
-                self.reply_msg_body += u'[Image]({image})\n\n'.format(image=self._format_url(data.get('img')))
-            if data.get('link'):
-                self.reply_msg_body += u'[Link]({link})\n\n'.format(link=self._format_url(data.get('link')))
-            self.reply_msg_body += u'[Mobile](https://m.xkcd.com/{num}/)\n\n'.format(num=comic_id)
-            if data.get('title'):
-                self.reply_msg_body += u'**Title:** {title}\n\n'.format(title=self._format_text(data.get('title', '')))
-            if data.get('transcript') and self.include_transcript:
-                self.reply_msg_body += u'**Transcript:** {transcript}\n\n'.format(
-                    transcript=self._format_text(re.sub('\n{{.+}}', '', data.get('transcript', ''))))
-            if data.get('alt'):
-                self.reply_msg_body += u'**Title-text:** {alt}\n\n'.format(alt=self._format_text(data.get('alt', '')))
-            if comic_id > 0:
-                explained = xkcd_fetcher.get_explained_link(comic_id)
-                self.reply_msg_body += u'[Comic Explanation]({link})\n\n'.format(link=explained)
+            if parts:
+                parts.append(u'----\n')
+            parts.append(self._get_fragment(comic_id, ref, xkcd_fetcher))
 
+            # Stats change with every reference, so they are never cached
             stats = datastore.get_stats(comic_id)
             if stats:
                 plural = 's' if stats['count'] != 1 else ''
-                self.reply_msg_body += u'**Stats:** This comic has been referenced {0} time{1}, representing {2:.4f}% of referenced xkcds.\n\n'.format(
-                    stats['count'], plural, stats['percentage'])
+                parts.append(u'**Stats:** This comic has been referenced {0} time{1}, representing {2:.4f}% of referenced xkcds.\n\n'.format(
+                    stats['count'], plural, stats['percentage']))
+
+        self.reply_msg_body = u''.join(parts)
+
+    def _get_fragment(self, comic_id, ref, xkcd_fetcher):
+        """
+        Returns the part of a comic's body that only depends on its json, rendering it once per comic and variant.
+        """
+        data = ref['data']
+        from_source = ref['href'].find('imgs.xkcd.com') != -1 or data.get('from_external') is True
+        key = (comic_id, self.include_transcript, from_source)
+
+        # The json is replaced, not mutated, when a comic is refreshed
+        cached = self.fragment_cache.get(key)
+        if cached is not None and cached[0] is data:
+            return cached[1]
+
+        parts = []
+        if from_source:
+            parts.append(u'[Original Source](https://xkcd.com/{num}/)\n\n'.format(num=comic_id))
+        elif data.get('img'):
+            parts.append(u'[Image]({image})\n\n'.format(image=self._format_url(data.get('img'))))
+        if data.get('link'):
+            parts.append(u'[Link]({link})\n\n'.format(link=self._format_url(data.get('link'))))
+        parts.append(u'[Mobile](https://m.xkcd.com/{num}/)\n\n'.format(num=comic_id))
+        if data.get('title'):
+            parts.append(u'**Title:** {title}\n\n'.format(title=self._format_text(data.get('title', ''))))
+        if data.get('transcript') and self.include_transcript:
+            parts.append(u'**Transcript:** {transcript}\n\n'.format(
+                transcript=self._format_text(re.sub('\n{{.+}}', '', data.get('transcript', '')))))
+        if data.get('alt'):
+            parts.append(u'**Title-text:** {alt}\n\n'.format(alt=self._format_text(data.get('alt', ''))))
+        if comic_id > 0:
+            explained = xkcd_fetcher.get_explained_link(comic_id)
+            parts.append(u'[Comic Explanation]({link})\n\n'.format(link=explained))
+
+        fragment = u''.join(parts)
+        self.fragment_cache[key] = (data, fragment)
+        return fragment
 
     def build_all(self, comment, refs, xkcd_fetcher, datastore, reply_obj):
         self.build_head(comment)
@@ -479,6 +536,4 @@ class ReferenceBuilder(object):
         return lines
 
     def _escape_markdown(self, text):
-        for c in MARKDOWN_ESCAPE_CHARACTERS:
-            text = text.replace(str(c), '\\' + str(c))
-        return text
+        return MARKDOWN_ESCAPE_REGEX.sub(r'\\\1', text)
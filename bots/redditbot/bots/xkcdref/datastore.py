@@ -1,7 +1,21 @@
 import os
+import time
 import sqlite3
+import logging
+import itertools
 
+import gevent
 import simplejson
+from gevent.lock import Semaphore
+from gevent.threadpool import ThreadPool
+
+from redditbot.base import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+QUERY_SECONDS = metrics.histogram('xkcdref_datastore_query_seconds',
+                                  'Latency of datastore reads and write transactions, queueing included', ['op'])
 
 
 class SimpleDataStore(object):
@@ -12,6 +26,9 @@ class SimpleDataStore(object):
     def open(self):
         if not self.conn:
             self.conn = sqlite3.connect(self.db_path)
+            # WAL lets readers run alongside a writer, and with synchronous=NORMAL commits do not fsync
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
 
     def close(self):
         if self.conn:
@@ -28,20 +45,117 @@ class SimpleDataStore(object):
         if self.conn:
             self.conn.commit()
 
+    def transaction(self, fn, *args):
+        """
+        Calls fn(self, *args) and commits, or rolls back if it raises.
+        """
+        self.open()
+        try:
+            result = fn(self, *args)
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        return result
+
+
+class Result(object):
+    """
+    Rows of a query read on another thread, with the parts of the cursor interface BotDataStore uses.
+    """
+
+    def __init__(self, rows, rowcount):
+        self.rows = rows
+        self.rowcount = rowcount
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class ThreadedDataStore(object):
+    """
+    Runs SQLite work on native threads so that queries and commits do not block the gevent hub.
+    Writes go through a single writer connection on its own thread and reads are spread over a pool of reader
+    connections. Every connection is opened and used on one thread only. Relies on WAL mode so readers do not
+    wait for the writer.
+    """
+
+    def __init__(self, db_path, readers=2):
+        self.db_path = db_path
+        self.writer = (ThreadPool(1), SimpleDataStore(self.db_path))
+        self.readers = [(ThreadPool(1), SimpleDataStore(self.db_path)) for i in xrange(readers)]
+        self.next_reader = itertools.cycle(self.readers)
+
+    def execute(self, *args, **kwargs):
+        pool, store = next(self.next_reader)
+        return pool.apply(self._read, (store,) + args, kwargs)
+
+    def _read(self, store, *args, **kwargs):
+        cursor = store.execute(*args, **kwargs)
+        return Result(cursor.fetchall(), cursor.rowcount)
+
+    def transaction(self, fn, *args):
+        pool, store = self.writer
+        return pool.apply(store.transaction, (fn,) + args)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        for pool, store in [self.writer] + self.readers:
+            pool.apply(store.close)
+            pool.kill()
+
 
 class BotDataStore(object):
-    def __init__(self, bot_name, database_path):
+    """
+    Writes are queued and committed together, once batch_size rows are queued or flush_interval seconds after the
+    first one, whichever comes first. Pass sync=True (or call flush()) where a following read must see the write.
+    With threaded=True, SQLite runs on native threads (see ThreadedDataStore) instead of the gevent hub.
+    """
+
+    def __init__(self, bot_name, database_path, batch_size=50, flush_interval=0.5, threaded=False, readers=2):
         # Create the path if it does not alreay exist
         if not os.path.exists(os.path.dirname(database_path)):
             os.makedirs(os.path.dirname(database_path))
 
         self.bot_name = bot_name
         self.database_path = database_path
-        self.datastore = SimpleDataStore(self.database_path)
+        if threaded:
+            self.datastore = ThreadedDataStore(self.database_path, readers)
+        else:
+            self.datastore = SimpleDataStore(self.database_path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.flusher = None
+        self.flush_lock = Semaphore()
+        self.ignores = None
+        self.ignores_version = None
+        self.ignores_checked = 0
+        self.ignores_check_interval = 10
         self.create()
 
     def create(self):
-        self.datastore.execute("""
+        self._transaction(self._create)
+        self._transaction(self._migrate)
+
+    def _execute(self, *args):
+        with QUERY_SECONDS.time(op='read'):
+            return self.datastore.execute(*args)
+
+    def _transaction(self, fn, *args):
+        with QUERY_SECONDS.time(op='write'):
+            return self.datastore.transaction(fn, *args)
+
+    def _create(self, db):
+        db.execute("""
             CREATE TABLE IF NOT EXISTS ignored_users (
                 bot_name TEXT,
                 target_name TEXT,
@@ -49,7 +163,7 @@ class BotDataStore(object):
             );
             """)
 
-        self.datastore.execute("""
+        db.execute("""
             CREATE TABLE IF NOT EXISTS xkcd_comic_references (
                 comic_id INTEGER,
                 time INTEGER NOT NULL,
@@ -60,7 +174,7 @@ class BotDataStore(object):
             );
             """)
 
-        self.datastore.execute("""
+        db.execute("""
             CREATE TABLE IF NOT EXISTS xkcd_comic_meta (
                 comic_id INTEGER PRIMARY KEY,
                 json TEXT,
@@ -71,7 +185,17 @@ class BotDataStore(object):
             );
             """)
 
-        self.datastore.execute("""
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS bot_replies (
+                bot_name TEXT,
+                parent_name TEXT,
+                reply_name TEXT,
+                time INTEGER NOT NULL,
+                PRIMARY KEY(bot_name, parent_name)
+            );
+            """)
+
+        db.execute("""
             CREATE VIEW IF NOT EXISTS references_counts AS
                 SELECT
                     comic_id,
@@ -94,27 +218,139 @@ class BotDataStore(object):
             ;
             """)
 
-        self.datastore.commit()
+        # Reference counters kept up to date by insert_xkcd_event, replacing reads of references_counts
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS xkcd_comic_counts (
+                comic_id INTEGER PRIMARY KEY,
+                comic_count INTEGER NOT NULL
+            );
+            """)
+
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS xkcd_reference_totals (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total INTEGER NOT NULL
+            );
+            """)
+
+    def _migrate(self, db):
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+
+        if version < 1:
+            # Backfill the counters from the existing references
+            db.execute('DELETE FROM xkcd_comic_counts')
+            db.execute('INSERT INTO xkcd_comic_counts SELECT comic_id, 0 FROM xkcd_comic_meta')
+            db.execute("""
+                INSERT OR REPLACE INTO xkcd_comic_counts
+                    SELECT comic_id, COUNT(*) FROM xkcd_comic_references GROUP BY comic_id
+                """)
+            db.execute("""
+                INSERT OR REPLACE INTO xkcd_reference_totals
+                    VALUES(0, (SELECT COUNT(*) FROM xkcd_comic_references))
+                """)
+            db.execute('PRAGMA user_version = 1')
 
-    def add_ignore(self, target):
-        self.datastore.execute(
+    def _queue_write(self, write, args, sync):
+        self.pending.append((write, args))
+        if sync or len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flusher is None:
+            self.flusher = gevent.spawn_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """
+        Commits all queued writes in a single transaction.
+        """
+        if self.flusher is not None and self.flusher is not gevent.getcurrent():
+            self.flusher.kill(block=False)
+        self.flusher = None
+
+        # Later flushes wait for earlier ones, so a flush returns once everything queued before it is committed
+        with self.flush_lock:
+            pending, self.pending = self.pending, []
+            if pending:
+                self._transaction(self._write_pending, pending)
+
+    def _write_pending(self, db, pending):
+        for write, args in pending:
+            try:
+                write(db, *args)
+            except Exception as e:
+                logger.exception('Exception while writing to the datastore')
+
+    def add_ignore(self, target, sync=False):
+        self._queue_write(self._write_ignore, (target,), sync)
+        if self.ignores is not None:
+            self.ignores.add(target.lower())
+
+    def _write_ignore(self, db, target):
+        db.execute(
             'INSERT INTO ignored_users VALUES(?, ?)',
             (self.bot_name, target)
         )
 
-        self.datastore.commit()
+    def is_ignored(self, name):
+        """
+        Checks name against an in-memory set of ignored users.
+        The set is reloaded when the database was changed by another connection (another process),
+        which is checked at most every ignores_check_interval seconds.
+        """
+        now = time.time()
+        if self.ignores is None or now - self.ignores_checked > self.ignores_check_interval:
+            # data_version only changes for commits made through other connections, so ask the writer's
+            version = self._transaction(self._data_version)
+            if self.ignores is None or version != self.ignores_version:
+                self.flush()
+                self.ignores = set(target.lower() for target in self.get_ignores())
+                self.ignores_version = version
+            self.ignores_checked = now
+
+        return name.lower() in self.ignores
+
+    def _data_version(self, db):
+        return db.execute('PRAGMA data_version').fetchone()[0]
 
     def get_ignores(self):
-        cursor = self.datastore.execute(
+        cursor = self._execute(
             'SELECT target_name FROM ignored_users WHERE bot_name = ?',
             (self.bot_name,)
         )
 
         return [r[0] for r in cursor]
 
+    def add_reply(self, parent_name, reply_name, sync=True):
+        # Synchronous by default: a reply missing from the ledger could be sent twice
+        self._queue_write(self._write_reply, (parent_name, reply_name, int(time.time())), sync)
+
+    def _write_reply(self, db, parent_name, reply_name, timestamp):
+        db.execute(
+            'INSERT OR REPLACE INTO bot_replies VALUES(?, ?, ?, ?)',
+            (self.bot_name, parent_name, reply_name, timestamp)
+        )
+
+    def has_reply(self, parent_name):
+        cursor = self._execute(
+            'SELECT 1 FROM bot_replies WHERE bot_name = ? AND parent_name = ?',
+            (self.bot_name, parent_name)
+        )
+
+        return cursor.fetchone() is not None
+
+    def has_replies(self):
+        cursor = self._execute('SELECT 1 FROM bot_replies WHERE bot_name = ? LIMIT 1', (self.bot_name,))
+
+        return cursor.fetchone() is not None
+
     def get_stats(self, comic_id):
-        cursor = self.datastore.execute(
-            'SELECT comic_count, comic_percentage FROM references_counts WHERE comic_id = ?',
+        cursor = self._execute(
+            """
+            SELECT
+                c.comic_count,
+                CASE WHEN t.total > 0 THEN (c.comic_count * 100.0) / t.total ELSE 0.0 END
+            FROM
+                xkcd_comic_counts c, xkcd_reference_totals t
+            WHERE c.comic_id = ? AND t.id = 0
+            """,
             (int(comic_id),)
         )
 
@@ -126,16 +362,26 @@ class BotDataStore(object):
             'percentage': meta[1]
         }
 
-    def insert_xkcd_event(self, comic_id, time, subreddit, user, link, from_external):
-        self.datastore.execute(
+    def insert_xkcd_event(self, comic_id, time, subreddit, user, link, from_external, sync=False):
+        self._queue_write(self._write_xkcd_event, (comic_id, time, subreddit, user, link), sync)
+
+    def _write_xkcd_event(self, db, comic_id, time, subreddit, user, link):
+        cursor = db.execute(
             'INSERT INTO xkcd_comic_references VALUES(?, ?, ?, ?, ?)',
             (int(comic_id), int(time), subreddit, user, link)
         )
 
-        self.datastore.commit()
+        # Duplicates are ignored by the UNIQUE constraint and leave rowcount at 0
+        if cursor.rowcount > 0:
+            db.execute('INSERT OR IGNORE INTO xkcd_comic_counts VALUES(?, 0)', (int(comic_id),))
+            db.execute(
+                'UPDATE xkcd_comic_counts SET comic_count = comic_count + 1 WHERE comic_id = ?',
+                (int(comic_id),)
+            )
+            db.execute('UPDATE xkcd_reference_totals SET total = total + 1 WHERE id = 0')
 
     def get_xkcd_meta(self, comic_id):
-        cursor = self.datastore.execute(
+        cursor = self._execute(
             'SELECT comic_id, json, hash_avg, hash_d, hash_p FROM xkcd_comic_meta WHERE comic_id = ?',
             (int(comic_id),)
         )
@@ -151,22 +397,55 @@ class BotDataStore(object):
             'hash_p': meta[4],
         }
 
-    def insert_xkcd_meta(self, comic_id, json, hash_avg, hash_d, hash_p):
-        r = self.datastore.execute(
+    def iter_xkcd_meta(self):
+        """
+        Yields the metadata of every comic, in comic id order, from a single query.
+        """
+        cursor = self._execute(
+            'SELECT comic_id, json, hash_avg, hash_d, hash_p FROM xkcd_comic_meta ORDER BY comic_id'
+        )
+
+        for meta in cursor:
+            yield {
+                'comic_id': meta[0],
+                'json_data': simplejson.loads(meta[1]),
+                'hash_avg': meta[2],
+                'hash_d': meta[3],
+                'hash_p': meta[4],
+            }
+
+    def insert_xkcd_meta(self, comic_id, json, hash_avg, hash_d, hash_p, sync=False):
+        self._queue_write(self._write_xkcd_meta, (comic_id, json, hash_avg, hash_d, hash_p), sync)
+
+    def _write_xkcd_meta(self, db, comic_id, json, hash_avg, hash_d, hash_p):
+        r = db.execute(
             'SELECT 1 FROM xkcd_comic_meta WHERE comic_id = ?',
             (int(comic_id),)
         )
 
         if r.fetchone() is None:
-            self.datastore.execute(
+            db.execute(
                 'INSERT INTO xkcd_comic_meta VALUES(?, ?, ?, ?, ?, ?)',
                 (int(comic_id), simplejson.dumps(json), json.get('title', ''), str(hash_avg), str(hash_d), str(hash_p))
             )
+            db.execute('INSERT OR IGNORE INTO xkcd_comic_counts VALUES(?, 0)', (int(comic_id),))
+
+    def update_xkcd_meta(self, comic_id, json, sync=False):
+        # Comics that were never stored (their first fetch failed) are inserted
+        self._queue_write(self._write_xkcd_meta_update, (comic_id, json), sync)
+
+    def _write_xkcd_meta_update(self, db, comic_id, json):
+        r = db.execute(
+            'UPDATE xkcd_comic_meta SET json = ?, title = ? WHERE comic_id = ?',
+            (simplejson.dumps(json), json.get('title', ''), int(comic_id))
+        )
 
-            self.datastore.commit()
+        if r.rowcount == 0:
+            self._write_xkcd_meta(db, comic_id, json, '', '', '')
 
     def close(self):
         try:
+            self.flush()
             self.datastore.close()
         except Exception as e:
             pass
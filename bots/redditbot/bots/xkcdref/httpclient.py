@@ -0,0 +1,95 @@
+import os
+import hashlib
+import logging
+
+import requests
+import simplejson
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class CachingHttpClient(object):
+    """
+    Keep-alive HTTP client with timeouts and retries.
+    With a cache_dir, responses carrying an ETag or Last-Modified header are kept on disk and revalidated with
+    If-None-Match/If-Modified-Since, so unchanged resources come back as a 304 without a body.
+    """
+
+    def __init__(self, cache_dir=None, timeout=10, retries=3, pool_size=8, user_agent=None):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.session = requests.Session()
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+
+        adapter = HTTPAdapter(pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504)))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Create the path if it does not already exist
+        if self.cache_dir and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get(self, url):
+        """
+        Returns the body of url, or None if the server did not answer with 200 (or 304 for a cached copy).
+        Network errors are raised.
+        """
+        entry = self._read_entry(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and entry:
+            return entry['body']
+        if response.status_code != 200:
+            return None
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            self._write_entry(url, {
+                'etag': etag,
+                'last_modified': last_modified,
+                'body': response.text,
+            })
+        return response.text
+
+    def _entry_path(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest() + '.json')
+
+    def _read_entry(self, url):
+        if not self.cache_dir:
+            return None
+
+        try:
+            with open(self._entry_path(url)) as f:
+                return simplejson.load(f)
+        except IOError:
+            return None
+        except ValueError:
+            logger.warn('Discarding corrupt http cache entry for {url}'.format(url=url))
+            return None
+
+    def _write_entry(self, url, entry):
+        if not self.cache_dir:
+            return
+
+        # Write to a temporary file first so readers never see a partial entry
+        path = self._entry_path(url)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                simplejson.dump(entry, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            logger.exception('Exception while writing http cache entry for {url}'.format(url=url))
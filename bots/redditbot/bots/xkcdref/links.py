@@ -0,0 +1,255 @@
+import re
+
+# Only needed by snudown_links, to compare with what reddit renders
+try:
+    import snudown
+    from bs4 import BeautifulSoup
+except ImportError:
+    snudown = None
+
+# Code spans and indented code blocks are never rendered as links
+CODE_SPAN_REGEX = re.compile(r'(?<!\\)(`+)(?!`).+?(?<!`)\1(?!`)', re.S)
+CODE_BLOCK_REGEX = re.compile(r'(?:\A|(?<=\n))[ \t]*\n((?:(?: {4}|\t)[^\n]*(?:\n|\Z))+)')
+
+# [id]: url "optional title"
+REFERENCE_REGEX = re.compile(r'^ {0,3}\[([^\]]+)\]:[ \t]*\n?[ \t]*<?([^\s>]+)>?(?:[ \t]+(?:"[^\n]*"|\'[^\n]*\'|\([^\n]*\)))?[ \t]*$',
+                             re.M)
+
+# Everything that can start a link. Bare urls follow snudown's autolinker: the scheme must not be glued to a word,
+# and www. must follow whitespace or punctuation.
+TOKEN_REGEX = re.compile(r"""
+    \\[\\`*_{}\[\]()#+\-.!:|&<>^~]
+  | \[
+  | <(?:https?|ftp)://[^\s<>]+>
+  | (?<![A-Za-z])(?:https?|ftp)://[^\s<]+
+  | (?<![^\s!-/:-@\[-`{-~])www\.[^\s<]+
+""", re.I | re.X)
+
+ENTITY_SUFFIX_REGEX = re.compile(r'&[A-Za-z0-9#]+;$')
+EMPHASIS_SUFFIX_REGEX = re.compile(r'[*_~]+$')
+EMPHASIS_RUN_REGEXES = {'*': re.compile(r'\*+'), '_': re.compile(r'_+'), '~': re.compile(r'~~+')}
+ESCAPE_REGEX = re.compile(r'\\([\\`*_{}\[\]()#+\-.!:|&<>^~])')
+TITLE_REGEX = re.compile(r'\s+(?:"[^"]*"|\'[^\']*\')\s*$')
+
+# A column of the line under a table header. Unlike sundown, which wants 3, snudown takes a single -
+UNDERLINE_CELL_REGEX = re.compile(r' *:?-+:? *(?:\||$)')
+
+BRACKET_PAIRS = {')': '(', ']': '[', '}': '{'}
+
+
+def extract_links(text):
+    """
+    Returns the targets of the links in a markdown text, in the order snudown would render them.
+    Understands inline links, reference links, <url> autolinks and bare http(s)/ftp/www urls, and skips code.
+    """
+    text = CODE_BLOCK_REGEX.sub(_blank, text)
+    text = CODE_SPAN_REGEX.sub(_blank, text)
+
+    references = {}
+    for m in REFERENCE_REGEX.finditer(text):
+        references.setdefault(m.group(1).strip().lower(), m.group(2))
+    text = REFERENCE_REGEX.sub(_blank, text)
+
+    links = []
+    for part in _split_tables(text):
+        _extract_inline_links(part, references, links)
+    return links
+
+
+def snudown_links(text):
+    """
+    Returns the targets of the links snudown renders for a markdown text, the way the bots found them before
+    extract_links. Needs snudown and beautifulsoup4, which the bots do not install: check that snudown is not None.
+    """
+    html = snudown.markdown(text.encode('utf-8'))
+    return [a.get('href') for a in BeautifulSoup(html, 'html.parser').find_all('a') if a.get('href')]
+
+
+def _extract_inline_links(text, references, links):
+    pos = 0
+    while True:
+        m = TOKEN_REGEX.search(text, pos)
+        if not m:
+            return
+
+        token = m.group()
+        pos = m.end()
+        if token[0] == '\\':
+            continue
+        if token[0] == '[':
+            link = _parse_link(text, m.start(), references)
+            if link:
+                href, pos = link
+                links.append(href)
+            else:
+                pos = m.start() + 1
+        elif token[0] == '<':
+            links.append(token[1:-1])
+        else:
+            href = _trim_autolink(token, text[text.rfind('\n', 0, m.start()) + 1:m.start()])
+            pos = m.start() + len(href)
+            if token[0] in 'wW':
+                href = 'http://' + href
+            links.append(href)
+
+
+def _blank(m):
+    # Keep offsets and line breaks intact so the surrounding markdown parses the same
+    return re.sub(r'[^\n]', ' ', m.group())
+
+
+def _split_tables(text):
+    """
+    Splits text into the parts snudown parses on their own: every cell of a table, and the text around tables.
+    """
+    if '|' not in text:
+        return [text]
+
+    parts = []
+    lines = text.split('\n')
+    start = 0
+    i = 0
+    while i < len(lines) - 1:
+        # A table starts a block: a header row right under a blank line, followed by its underline
+        columns = 0
+        if '|' in lines[i] and (i == 0 or not lines[i - 1].strip()):
+            columns = _table_columns(lines[i], lines[i + 1])
+        if not columns:
+            i += 1
+            continue
+
+        parts.append('\n'.join(lines[start:i]))
+        parts.extend(_table_cells(lines[i], columns))
+
+        # Rows go on for as long as lines have a pipe in them
+        i += 2
+        while i < len(lines) and '|' in lines[i]:
+            parts.extend(_table_cells(lines[i], columns))
+            i += 1
+        start = i
+
+    parts.append('\n'.join(lines[start:]))
+    return parts
+
+
+def _table_columns(header, underline):
+    """
+    Returns the number of columns of the table that header and underline start, or 0 if they do not start one.
+    """
+    header = header.rstrip()
+    if '|' not in header:
+        return 0
+    columns = header.count('|') - header.startswith('|') - header.endswith('|') + 1
+
+    i = 1 if underline.startswith('|') else 0
+    for _ in xrange(columns):
+        m = UNDERLINE_CELL_REGEX.match(underline, i)
+        if i >= len(underline) or not m:
+            return 0
+        i = m.end()
+    return columns
+
+
+def _table_cells(row, columns):
+    # Cells past the header's columns are dropped, and a pipe splits cells even when escaped
+    row = row.strip()
+    if row.startswith('|'):
+        row = row[1:]
+    return row.split('|')[:columns]
+
+
+def _parse_link(text, start, references):
+    """
+    Parses the link starting at the [ at start. Returns (href, end) or None if it is not a link.
+    """
+    # Link text, with nested brackets
+    end = _find_closing(text, start + 1, '[', ']')
+    if end is None:
+        return None
+    label = text[start + 1:end]
+
+    i = end + 1
+    while i < len(text) and text[i].isspace():
+        i += 1
+
+    # Inline link: [text](url "title")
+    if i < len(text) and text[i] == '(':
+        close = _find_closing(text, i + 1, '(', ')')
+        if close is None:
+            return None
+        href = TITLE_REGEX.sub('', text[i + 1:close]).strip()
+        if href.startswith('<') and href.endswith('>'):
+            href = href[1:-1]
+        return ESCAPE_REGEX.sub(r'\1', href), close + 1
+
+    # Reference link: [text][id] or [text][]
+    if i < len(text) and text[i] == '[':
+        close = _find_closing(text, i + 1, '[', ']')
+        if close is None:
+            return None
+        key = text[i + 1:close].strip() or label
+        href = references.get(' '.join(key.split()).lower())
+        return (href, close + 1) if href else None
+
+    # Shortcut reference: [id]
+    href = references.get(' '.join(label.split()).lower())
+    return (href, end + 1) if href else None
+
+
+def _find_closing(text, i, opening, closing):
+    depth = 0
+    while i < len(text):
+        c = text[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == opening:
+            depth += 1
+        elif c == closing:
+            if depth == 0:
+                return i
+            depth -= 1
+        i += 1
+    return None
+
+
+def _trim_autolink(url, before=''):
+    """
+    Trims what snudown leaves out of a bare url. before is the text of the line up to the url.
+    """
+    url = _trim_punctuation(url)
+
+    # Inside *emphasis*, **strong** or ~~strikethrough~~ the url ends where the emphasis closes
+    m = EMPHASIS_SUFFIX_REGEX.search(url)
+    if m and _closes_emphasis(m.group(), before):
+        url = _trim_punctuation(url[:m.start()])
+    return url
+
+
+def _closes_emphasis(run, before):
+    # Emphasis is open when an odd number of runs of its delimiter come before the url on the line
+    for c in set(run):
+        if c == '~' and '~~' not in run:
+            return False
+        if len(EMPHASIS_RUN_REGEXES[c].findall(before)) % 2 == 0:
+            return False
+    return True
+
+
+def _trim_punctuation(url):
+    # Trailing punctuation and entities are not part of a bare url
+    while url:
+        if url[-1] in '?!.,:':
+            url = url[:-1]
+        elif url[-1] == ';':
+            m = ENTITY_SUFFIX_REGEX.search(url)
+            url = url[:m.start()] if m else url[:-1]
+        else:
+            break
+
+    # Drop a closing bracket that was not opened inside the url, as in "(see http://xkcd.com/1)"
+    if url and url[-1] in BRACKET_PAIRS and url.count(url[-1]) > url.count(BRACKET_PAIRS[url[-1]]):
+        url = url[:-1]
+    elif url and url[-1] in '"\'' and url.count(url[-1]) % 2:
+        url = url[:-1]
+    return url
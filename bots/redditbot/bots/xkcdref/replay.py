@@ -0,0 +1,96 @@
+# Must be first for monkey_patch()
+from redditbot.base import patch_all
+patch_all()
+
+import shutil
+import logging
+import argparse
+import tempfile
+
+import gevent
+import simplejson
+
+from redditbot.base.handlers import MultiBotHandler
+from redditbot.base.ratelimit import RateGovernor
+from redditbot.base.replay import ReplayFeed, ReplayMixin, ReplayStats, VirtualClock
+from datastore import BotDataStore
+from runbot import create_bots
+from xkcdfetcher import XkcdFetcher
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class OfflineHttpClient(object):
+    def get(self, url):
+        return None
+
+
+def replay(capture_path, db_path=None, speedup=10.0, tail=60):
+    """
+    Runs the xkcd bots through MultiBotHandler against a capture file, on a virtual clock running speedup times
+    faster than real time, and returns the ReplayStats report.
+    Comics (and the ignore list) are copied from the datastore at db_path into a scratch datastore, so replies and
+    references made during the replay do not touch it. Without it no comic is known, so nothing gets a reply.
+    """
+    feed = ReplayFeed.load(capture_path)
+    if feed.start is None:
+        raise Exception("Nothing to replay in {path}".format(path=capture_path))
+
+    path = tempfile.mkdtemp(prefix='xkcdref-replay-')
+    datastore = BotDataStore('xkcd_transcriber', path + '/xkcd.db')
+    try:
+        if db_path:
+            source = BotDataStore('xkcd_transcriber', db_path)
+            for meta in source.iter_xkcd_meta():
+                datastore.insert_xkcd_meta(meta['comic_id'], meta['json_data'], meta['hash_avg'], meta['hash_d'],
+                                           meta['hash_p'])
+            for target in source.get_ignores():
+                datastore.add_ignore(target)
+            datastore.flush()
+            source.close()
+
+        xkcd_fetcher = XkcdFetcher(datastore, http_client=OfflineHttpClient())
+        xkcd_fetcher.load_from_datastore()
+
+        # Start a little before the first capture, so the first cycles see its items
+        clock = VirtualClock(feed.start - 1, speedup)
+        stats = ReplayStats()
+        bots = create_bots(datastore, xkcd_fetcher, mixin=ReplayMixin, feed=feed, stats=stats, clock=clock,
+                           auth={'username': 'xkcd_transcriber', 'password': ''}, rate_governor=RateGovernor(1000),
+                           seen_db_path=None, dry_run=False)
+
+        handler = MultiBotHandler(bots)
+        gevent.spawn(handler.run)
+        clock.sleep(feed.end + tail - clock.time())
+        handler.stop()
+
+        report = stats.report()
+        report['virtual_seconds'] = clock.time() - clock.start
+        report['speedup'] = speedup
+        return report
+    finally:
+        datastore.close()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Replay captured reddit traffic through the xkcd bots')
+    parser.add_argument('capture', help='Capture file written with XKCD_CAPTURE_LOCATION set')
+    parser.add_argument('--db', help='Datastore to copy comics and ignored users from')
+    parser.add_argument('--speedup', type=float, default=10.0, help='Virtual seconds per real second')
+    parser.add_argument('--tail', type=float, default=60, help='Virtual seconds to keep running after the capture')
+    parser.add_argument('--output', help='Write the report as json to this file')
+    # settings parses its own --settings flag
+    args, _ = parser.parse_known_args()
+
+    report = replay(args.capture, args.db, args.speedup, args.tail)
+    print simplejson.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            simplejson.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    run()
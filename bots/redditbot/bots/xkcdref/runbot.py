@@ -2,10 +2,16 @@
 from redditbot.base import patch_all
 patch_all()
 
+import signal
 import logging
 
+import gevent
+
 from redditbot.bots import settings
+from redditbot.base.admin import AdminServer
+from redditbot.base.capture import CaptureWriter
 from redditbot.base.handlers import MultiBotHandler
+from redditbot.base.watchdog import HubWatchdog
 from bot import SubmissionXkcdBot, CommentXkcdBot, MailXkcdBot, VoteXkcdBot
 from datastore import BotDataStore
 from xkcdfetcher import XkcdFetcher
@@ -13,56 +19,101 @@ from xkcdfetcher import XkcdFetcher
 logging.basicConfig()
 
 
-def run():
-    datastore = BotDataStore('xkcd_transcriber', settings.XKCD_DB_LOCATION)
-    xkcd_fetcher = XkcdFetcher(datastore)
+def create_bots(datastore, xkcd_fetcher, mixin=None, **kwargs):
+    """
+    Creates the xkcd bots. kwargs are passed to every bot, overriding their settings,
+    and mixin is mixed in front of every bot class.
+    """
+    def create(cls, **bot_kwargs):
+        if mixin is not None:
+            # Keep the class name, handlers are named after it
+            cls = type(cls.__name__, (mixin, cls), {})
+        bot_kwargs.update(kwargs)
+        return cls(**bot_kwargs)
 
     # If fetch_limit is set to None, it will keep on going back for hugely old submissions
-    submission_bot = SubmissionXkcdBot(user_agent='xkcdref bot (submission) by %s' % settings.AUTHOR,
-                                       auth=settings.REDDIT_ACCOUNTS['xkcd_transcriber'],
-                                       delay=20,
-                                       fetch_limit=300,
-                                       cache_size=600,
-                                       dry_run=settings.DRY_RUN,
-                                       subreddit='all',
-                                       datastore=datastore,
-                                       xkcd_fetcher=xkcd_fetcher)
-
-    comment_bot = CommentXkcdBot(user_agent='xkcdref bot (comment) by %s' % settings.AUTHOR,
-                                 auth=settings.REDDIT_ACCOUNTS['xkcd_transcriber'],
-                                 delay=15,
-                                 fetch_limit=None,
-                                 cache_size=2000,
-                                 dry_run=settings.DRY_RUN,
-                                 subreddit='all',
-                                 datastore=datastore,
-                                 xkcd_fetcher=xkcd_fetcher)
-
-    mail_bot = MailXkcdBot(user_agent='xkcdref bot (message) by %s' % settings.AUTHOR,
-                           auth=settings.REDDIT_ACCOUNTS['xkcd_transcriber'],
-                           delay=60,
-                           fetch_limit=None,
-                           cache_size=0,
-                           dry_run=settings.DRY_RUN,
-                           datastore=datastore,
-                           xkcd_fetcher=xkcd_fetcher)
-
-    vote_bot = VoteXkcdBot(user_agent='xkcdref bot (vote) by %s' % settings.AUTHOR,
-                           auth=settings.REDDIT_ACCOUNTS['xkcd_transcriber'],
-                           delay=300,
-                           fetch_limit=None,
-                           cache_size=0,
-                           dry_run=settings.DRY_RUN,
-                           monitored_user='xkcd_transcriber',
-                           score_threshold_min=-1)
-
-    # Run all bots
-    MultiBotHandler([
-        submission_bot,
-        comment_bot,
-        mail_bot,
-        vote_bot
-    ]).run()
+    submission_bot = create(SubmissionXkcdBot,
+                            user_agent='xkcdref bot (submission) by %s' % settings.AUTHOR,
+                            auth=settings.REDDIT_ACCOUNTS['xkcd_transcriber'],
+                            delay=20,
+                            min_delay=10,
+                            max_delay=120,
+                            fetch_limit=300,
+                            catch_up=True,
+                            cache_size=600,
+                            seen_db_path=settings.XKCD_SEEN_DB_LOCATION or None,
+                            dry_run=settings.DRY_RUN,
+                            subreddit='all',
+                            datastore=datastore,
+                            xkcd_fetcher=xkcd_fetcher)
+
+    comment_bot = create(CommentXkcdBot,
+                         user_agent='xkcdref bot (comment) by %s' % settings.AUTHOR,
+                         auth=settings.REDDIT_ACCOUNTS['xkcd_transcriber'],
+                         delay=15,
+                         min_delay=5,
+                         max_delay=60,
+                         fetch_limit=None,
+                         cache_size=2000,
+                         concurrency=4,
+                         seen_db_path=settings.XKCD_SEEN_DB_LOCATION or None,
+                         dry_run=settings.DRY_RUN,
+                         subreddit='all',
+                         datastore=datastore,
+                         xkcd_fetcher=xkcd_fetcher)
+
+    mail_bot = create(MailXkcdBot,
+                      user_agent='xkcdref bot (message) by %s' % settings.AUTHOR,
+                      auth=settings.REDDIT_ACCOUNTS['xkcd_transcriber'],
+                      delay=60,
+                      min_delay=30,
+                      max_delay=600,
+                      fetch_limit=None,
+                      cache_size=0,
+                      dry_run=settings.DRY_RUN,
+                      datastore=datastore,
+                      xkcd_fetcher=xkcd_fetcher)
+
+    vote_bot = create(VoteXkcdBot,
+                      user_agent='xkcdref bot (vote) by %s' % settings.AUTHOR,
+                      auth=settings.REDDIT_ACCOUNTS['xkcd_transcriber'],
+                      delay=300,
+                      min_delay=120,
+                      max_delay=1800,
+                      fetch_limit=None,
+                      cache_size=0,
+                      dry_run=settings.DRY_RUN,
+                      monitored_user='xkcd_transcriber',
+                      score_threshold_min=-1)
+
+    return [submission_bot, comment_bot, mail_bot, vote_bot]
+
+
+def run():
+    datastore = BotDataStore('xkcd_transcriber', settings.XKCD_DB_LOCATION, threaded=True)
+    xkcd_fetcher = XkcdFetcher(datastore, http_cache_dir=settings.XKCD_HTTP_CACHE_LOCATION or None)
+    xkcd_fetcher.start_warmup()
+    xkcd_fetcher.start_refresher()
+    capture = CaptureWriter(settings.XKCD_CAPTURE_LOCATION) if settings.XKCD_CAPTURE_LOCATION else None
+    watchdog = HubWatchdog()
+    watchdog.start()
+    admin = None
+    if settings.ADMIN_PORT:
+        admin = AdminServer(settings.ADMIN_PORT)
+        admin.route('/blocking', lambda params: watchdog.report())
+        admin.start()
+
+    # Run all bots, write out queued rows on the way out. SIGTERM would exit without running finally, so it stops
+    # the bots instead
+    try:
+        handler = MultiBotHandler(create_bots(datastore, xkcd_fetcher, capture=capture))
+        handler.install_controls(admin)
+        gevent.signal(signal.SIGTERM, handler.stop)
+        handler.run()
+    finally:
+        datastore.close()
+        if capture is not None:
+            capture.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+# Must be first for monkey_patch(), the client and the stand-in server share this process
+from redditbot.base import patch_all
+patch_all()
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from gevent.pywsgi import WSGIServer
+
+from httpclient import CachingHttpClient
+
+
+class StandInServer(object):
+    """
+    Serves fixtures (path -> (status, headers, body)) over HTTP on a free port and records the requests it gets.
+    Answers 304 to a conditional request matching the fixture's ETag or Last-Modified header.
+    """
+
+    def __init__(self):
+        self.fixtures = {}
+        self.requests = []
+        self.server = WSGIServer(('127.0.0.1', 0), self._app, log=None)
+
+    def start(self):
+        self.server.start()
+        return 'http://127.0.0.1:{port}'.format(port=self.server.server_port)
+
+    def stop(self):
+        self.server.stop()
+
+    def _app(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        self.requests.append((path, environ.get('HTTP_IF_NONE_MATCH'), environ.get('HTTP_IF_MODIFIED_SINCE')))
+        if path not in self.fixtures:
+            start_response('404 Not Found', [('Content-Length', '0')])
+            return ['']
+
+        status, headers, body = self.fixtures[path]
+        etag = dict(headers).get('ETag')
+        last_modified = dict(headers).get('Last-Modified')
+        if (etag and environ.get('HTTP_IF_NONE_MATCH') == etag) or \
+                (last_modified and environ.get('HTTP_IF_MODIFIED_SINCE') == last_modified):
+            start_response('304 Not Modified', headers)
+            return ['']
+
+        start_response(status, headers + [('Content-Length', str(len(body)))])
+        return [body]
+
+
+class CachingHttpClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.base_url = self.server.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.client = CachingHttpClient(self.cache_dir, timeout=5, retries=0)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_etag_round_trip(self):
+        self.server.fixtures['/1/info.0.json'] = ('200 OK', [('ETag', '"v1"')], '{"num": 1}')
+        self.assertEqual(self.client.get(self.base_url + '/1/info.0.json'), '{"num": 1}')
+        self.assertEqual(self.client.get(self.base_url + '/1/info.0.json'), '{"num": 1}')
+        self.assertEqual(self.server.requests, [('/1/info.0.json', None, None), ('/1/info.0.json', '"v1"', None)])
+
+    def test_last_modified_round_trip(self):
+        last_modified = 'Mon, 01 Jan 2018 00:00:00 GMT'
+        self.server.fixtures['/info.0.json'] = ('200 OK', [('Last-Modified', last_modified)], '{"num": 2}')
+        self.client.get(self.base_url + '/info.0.json')
+        self.assertEqual(self.client.get(self.base_url + '/info.0.json'), '{"num": 2}')
+        self.assertEqual(self.server.requests[-1], ('/info.0.json', None, last_modified))
+
+    def test_not_modified_served_from_disk(self):
+        self.server.fixtures['/3/info.0.json'] = ('200 OK', [('ETag', '"v3"')], '{"num": 3}')
+        self.client.get(self.base_url + '/3/info.0.json')
+
+        # A new client (like after a restart) only has the disk cache
+        client = CachingHttpClient(self.cache_dir, timeout=5, retries=0)
+        self.assertEqual(client.get(self.base_url + '/3/info.0.json'), '{"num": 3}')
+        self.assertEqual(self.server.requests[-1], ('/3/info.0.json', '"v3"', None))
+
+    def test_changed_resource_replaces_entry(self):
+        self.server.fixtures['/4/info.0.json'] = ('200 OK', [('ETag', '"v1"')], '{"num": 4}')
+        self.client.get(self.base_url + '/4/info.0.json')
+        self.server.fixtures['/4/info.0.json'] = ('200 OK', [('ETag', '"v2"')], '{"num": 4, "transcript": "x"}')
+        self.assertEqual(self.client.get(self.base_url + '/4/info.0.json'), '{"num": 4, "transcript": "x"}')
+        self.assertEqual(self.client.get(self.base_url + '/4/info.0.json'), '{"num": 4, "transcript": "x"}')
+        self.assertEqual(self.server.requests[-1], ('/4/info.0.json', '"v2"', None))
+
+    def test_non_200_returns_none(self):
+        self.assertIsNone(self.client.get(self.base_url + '/404/info.0.json'))
+        self.server.fixtures['/gone'] = ('410 Gone', [('ETag', '"v1"')], 'gone')
+        self.assertIsNone(self.client.get(self.base_url + '/gone'))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_response_without_validators_not_cached(self):
+        self.server.fixtures['/5/info.0.json'] = ('200 OK', [], '{"num": 5}')
+        self.assertEqual(self.client.get(self.base_url + '/5/info.0.json'), '{"num": 5}')
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_corrupt_entry_refetched(self):
+        url = self.base_url + '/6/info.0.json'
+        self.server.fixtures['/6/info.0.json'] = ('200 OK', [('ETag', '"v6"')], '{"num": 6}')
+        with open(self.client._entry_path(url), 'w') as f:
+            f.write('{"etag": "v6", "bo')
+
+        self.assertEqual(self.client.get(url), '{"num": 6}')
+        self.assertEqual(self.server.requests[-1], ('/6/info.0.json', None, None))
+        self.assertEqual(self.client.get(url), '{"num": 6}')
+        self.assertEqual(self.server.requests[-1], ('/6/info.0.json', '"v6"', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from links import extract_links, snudown, snudown_links
+
+# Markdown -> the hrefs expected for it, in order. They were checked against sundown (misaka 1.0.2), not snudown
+# itself, and follow snudown where the two differ: nested parentheses in inline links and table underlines with
+# fewer than 3 dashes. SnudownParityTest compares them with snudown when it is installed.
+CASES = [
+    (u'see http://xkcd.com/1/ for more', [u'http://xkcd.com/1/']),
+    (u'(see http://xkcd.com/1)', [u'http://xkcd.com/1']),
+    (u'relevant: https://xkcd.com/927.', [u'https://xkcd.com/927']),
+    (u'www.xkcd.com/2, nice', [u'http://www.xkcd.com/2']),
+    (u'foowww.xkcd.com/2 foohttp://xkcd.com/3', []),
+    (u'[this one](http://xkcd.com/4 "title") and [that](<http://xkcd.com/5>)',
+     [u'http://xkcd.com/4', u'http://xkcd.com/5']),
+    (u'[wiki](http://en.wikipedia.org/wiki/Foo_(bar)) x', [u'http://en.wikipedia.org/wiki/Foo_(bar)']),
+    (u'[esc](http://xkcd.com/6\\)) x', [u'http://xkcd.com/6)']),
+    (u'[http://xkcd.com/7](http://xkcd.com/8)', [u'http://xkcd.com/8']),
+    (u'[a][1] and [b][] and [c]\n\n[1]: http://xkcd.com/9\n[b]: http://xkcd.com/10 "t"\n[C]: http://xkcd.com/11',
+     [u'http://xkcd.com/9', u'http://xkcd.com/10', u'http://xkcd.com/11']),
+    (u'[not a link] http://xkcd.com/12', [u'http://xkcd.com/12']),
+    (u'`http://xkcd.com/13` and\n\n    http://xkcd.com/14\n\nhttp://xkcd.com/15', [u'http://xkcd.com/15']),
+    (u'<http://xkcd.com/16> \\[x](http://xkcd.com/17)', [u'http://xkcd.com/16', u'http://xkcd.com/17']),
+    (u'http://xkcd.com/18&gt; and http://imgs.xkcd.com/comics/a.png!',
+     [u'http://xkcd.com/18', u'http://imgs.xkcd.com/comics/a.png']),
+    (u'[](/adorkable "hi") ünïcode http://xkcd.com/19', [u'/adorkable', u'http://xkcd.com/19']),
+    (u'[unclosed](http://xkcd.com/20', [u'http://xkcd.com/20']),
+
+    # Bare urls inside emphasis end where the emphasis closes
+    (u'**https://xkcd.com/4**', [u'https://xkcd.com/4']),
+    (u'*https://xkcd.com/4*', [u'https://xkcd.com/4']),
+    (u'_https://xkcd.com/4_', [u'https://xkcd.com/4']),
+    (u'~~https://xkcd.com/4~~', [u'https://xkcd.com/4']),
+    (u'***https://xkcd.com/4***', [u'https://xkcd.com/4']),
+    (u'*__https://xkcd.com/4__*', [u'https://xkcd.com/4']),
+    (u'*(https://xkcd.com/5)*', [u'https://xkcd.com/5']),
+    (u'*see https://xkcd.com/4.*', [u'https://xkcd.com/4']),
+    (u'*https://xkcd.com/4*!', [u'https://xkcd.com/4']),
+    (u'**www.xkcd.com/4**', [u'http://www.xkcd.com/4']),
+    (u'**a https://xkcd.com/4** b **c**', [u'https://xkcd.com/4']),
+    (u'**a** *b https://xkcd.com/4*', [u'https://xkcd.com/4']),
+    (u'*a https://xkcd.com/4**', [u'https://xkcd.com/4']),
+    (u'~~a https://xkcd.com/4~~', [u'https://xkcd.com/4']),
+
+    # ... and keep delimiters that close nothing
+    (u'https://xkcd.com/4**', [u'https://xkcd.com/4**']),
+    (u'*a* https://xkcd.com/4*', [u'https://xkcd.com/4*']),
+    (u'_a_ https://xkcd.com/4_', [u'https://xkcd.com/4_']),
+    (u'see https://en.wikipedia.org/wiki/Foo_', [u'https://en.wikipedia.org/wiki/Foo_']),
+
+    # Table cells are parsed on their own
+    (u'a | b\n--|--\nhttps://xkcd.com/1|https://xkcd.com/2', [u'https://xkcd.com/1', u'https://xkcd.com/2']),
+    (u'|a|b|\n|:--|--:|\n|https://xkcd.com/1|**https://xkcd.com/2**|', [u'https://xkcd.com/1', u'https://xkcd.com/2']),
+    (u'a | b\n---|---\nhttps://xkcd.com/1|https://xkcd.com/2|https://xkcd.com/3',
+     [u'https://xkcd.com/1', u'https://xkcd.com/2']),
+    (u'a | b\n---|---\n[x|y](https://xkcd.com/1)|https://xkcd.com/2', [u'https://xkcd.com/1']),
+    (u'a | b\n---|---\nx|y\nno table https://xkcd.com/1|x\n\nhttps://xkcd.com/2 | x',
+     [u'https://xkcd.com/1', u'https://xkcd.com/2']),
+]
+
+
+class ExtractLinksTest(unittest.TestCase):
+    def test_cases(self):
+        for text, expected in CASES:
+            self.assertEqual(extract_links(text), expected, text)
+
+    def test_xkcd_link_in_bold(self):
+        self.assertEqual(extract_links(u'Obligatory **https://xkcd.com/927**, as always'), [u'https://xkcd.com/927'])
+
+
+@unittest.skipUnless(snudown, 'snudown and beautifulsoup4 are needed to compare with the rendered html')
+class SnudownParityTest(unittest.TestCase):
+    def test_cases(self):
+        for text, _ in CASES:
+            self.assertEqual(extract_links(text), snudown_links(text), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,45 @@
-import urllib2
 import re
+import time
 import logging
 import urlparse
 
+import gevent
+import gevent.pool
+import pylru
 import simplejson
+from gevent.lock import Semaphore
+
+from redditbot.base import metrics
+from httpclient import CachingHttpClient
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-XKCD_JSON_API_URL = 'http://xkcd.com/{comic_id}/info.0.json'
+LOOKUPS = metrics.counter('xkcdref_fetcher_lookups_total', 'get_json lookups, by kind of url and result (hit or miss)',
+                          ['kind', 'result'])
+
+XKCD_BASE_URL = 'https://xkcd.com'
+XKCD_JSON_API_PATH = '/{comic_id}/info.0.json'
+XKCD_LATEST_JSON_API_PATH = '/info.0.json'
 XKCD_EXPLAINED_URL = 'https://www.explainxkcd.com/wiki/index.php/{comic_id}#Explanation'
 
 
 class XkcdFetcher(object):
-    def __init__(self, datastore):
+    def __init__(self, datastore, warmup_concurrency=8, refresh_interval=60, negative_ttl=600,
+                 negative_cache_size=10000, base_url=XKCD_BASE_URL, http_cache_dir=None, http_client=None):
         self.datastore = datastore
+        self.base_url = base_url
+        self.http_client = http_client or CachingHttpClient(http_cache_dir, pool_size=warmup_concurrency)
+        self.warmup_concurrency = warmup_concurrency
+        self.warmup_greenlet = None
+        self.refresher_greenlet = None
+        self.refresh_interval = refresh_interval
+        self.refresh_lock = Semaphore()
+        self.last_refresh = 0
+        self.negative_ttl = negative_ttl
+        self.negative_cache = pylru.lrucache(negative_cache_size)
         self.next_index = 1
+        self.failed_ids = set()
         self.reverse_image_index = {}
         self.reverse_hash_index = {}
         self.json_index = {}
@@ -26,54 +50,212 @@ class XkcdFetcher(object):
         parsed = urlparse.urlparse(url)
 
         if re.match('^(www\.)?imgs\.xkcd\.com$', parsed.netloc.lower()):
-            if parsed.path not in self.reverse_image_index:
-                self._load_indexes()
+            # While warming up, unknown images are served as misses rather than waiting for the warmup
+            key = ('img', parsed.path)
+            if parsed.path not in self.reverse_image_index and not self.is_warming_up() and not self._is_miss(key):
+                if self._refresh_indexes() and parsed.path not in self.reverse_image_index:
+                    self._add_miss(key)
             comic_id = self.reverse_image_index.get(parsed.path)
-            return self.json_index.get(comic_id) if comic_id else None
+            return self._lookup_result('image', self.json_index.get(comic_id) if comic_id else None)
 
         if re.match('^(www\.)?xkcd\.com$', parsed.netloc.lower()) and re.match('^/\d+/?$', parsed.path):
             m = re.search('^/(\d+)/?$', parsed.path)
             comic_id = int(m.group(1))
-            if comic_id not in self.json_index:
-                self._load_indexes()
-            return self.json_index.get(comic_id) if comic_id else None
+            key = ('id', comic_id)
+            if comic_id not in self.json_index and not self._is_miss(key):
+                # Comics behind the index are missing because their fetch failed (or the warmup has yet to get
+                # to them), so they are loaded on their own; newer ones are looked for by refreshing the index
+                if comic_id < self.next_index or comic_id in self.failed_ids or self.is_warming_up():
+                    self._load_comic(comic_id)
+                    looked_up = True
+                else:
+                    looked_up = self._refresh_indexes()
+                # A refresh skipped for refresh_interval did not look, so the id is not a miss yet
+                if looked_up and comic_id not in self.json_index:
+                    self._add_miss(key)
+            return self._lookup_result('comic', self.json_index.get(comic_id) if comic_id else None)
 
         if re.match('^imgur\.com$', parsed.netloc):
             pass
 
-        return None
+        return self._lookup_result('other', None)
+
+    def _lookup_result(self, kind, j):
+        LOOKUPS.inc(kind=kind, result='hit' if j else 'miss')
+        return j
 
     def get_explained_link(self, comic_id):
         return XKCD_EXPLAINED_URL.format(comic_id=comic_id)
 
+    def _is_miss(self, key):
+        expires = self.negative_cache.get(key)
+        if expires is None:
+            return False
+        if expires < time.time():
+            del self.negative_cache[key]
+            return False
+        return True
+
+    def _add_miss(self, key):
+        self.negative_cache[key] = time.time() + self.negative_ttl
+
+    def _refresh_indexes(self):
+        """
+        Loads comics newer than the index, at most once per refresh_interval.
+        Greenlets asking while a refresh is running wait for it instead of starting their own.
+        Returns whether comics were looked for, False if the refresh was skipped.
+        """
+        if self.refresh_lock.locked():
+            self.refresh_lock.wait()
+            return True
+        if time.time() - self.last_refresh < self.refresh_interval:
+            return False
+
+        with self.refresh_lock:
+            self.last_refresh = time.time()
+            self._load_indexes()
+        return True
+
+    def start_refresher(self, interval=600, recheck=3):
+        """
+        Runs refresh() every interval seconds in a background greenlet, once the warmup is done.
+        """
+        self.refresher_greenlet = gevent.spawn(self._run_refresher, interval, recheck)
+        return self.refresher_greenlet
+
+    def is_refreshing(self):
+        return self.refresher_greenlet is not None and not self.refresher_greenlet.ready()
+
+    def _run_refresher(self, interval, recheck):
+        if self.warmup_greenlet is not None:
+            self.warmup_greenlet.join()
+
+        while True:
+            try:
+                self.refresh(recheck)
+            except Exception as e:
+                logger.exception('Exception while refreshing xkcd comics')
+            gevent.sleep(interval)
+
+    def refresh(self, recheck=3):
+        """
+        Retries the comics that failed to load and loads those published since the last refresh, then re-fetches
+        the latest recheck comics, whose json (the transcript in particular) is often filled in after publication.
+        """
+        latest = self._get_latest_comic_id()
+        if latest is None:
+            return
+
+        for comic_id in sorted(self.failed_ids) + range(self.next_index, latest + 1):
+            self._try_comic(comic_id)
+        self.next_index = max(self.next_index, latest + 1)
+
+        for comic_id in xrange(max(1, latest - recheck + 1), latest + 1):
+            j = self._get_xkcd_json(comic_id)
+            if j and j != self.json_index.get(comic_id):
+                logger.info('Comic {id} changed since it was loaded, updating'.format(id=comic_id))
+                self.datastore.update_xkcd_meta(comic_id, j)
+                self._index_meta(comic_id, {'json_data': j, 'hash_avg': None})
+                self.failed_ids.discard(comic_id)
+
+    def start_warmup(self):
+        """
+        Runs warmup() in a background greenlet. get_json keeps serving what is loaded so far in the meantime.
+        """
+        self.warmup_greenlet = gevent.spawn(self.warmup)
+        return self.warmup_greenlet
+
+    def is_warming_up(self):
+        return self.warmup_greenlet is not None and not self.warmup_greenlet.ready()
+
+    def warmup(self):
+        """
+        Loads every comic up to the latest one, fetching missing comics concurrently with a bounded pool.
+        """
+        start_time = time.time()
+        if not self.json_index:
+            self.load_from_datastore()
+
+        latest = self._get_latest_comic_id()
+        if latest is None:
+            logger.warn('Could not fetch the latest comic id: warming up sequentially')
+            self._load_indexes()
+            return
+
+        pool = gevent.pool.Pool(self.warmup_concurrency)
+        for comic_id in xrange(1, latest + 1):
+            if comic_id not in self.json_index:
+                pool.spawn(self._try_comic, comic_id)
+        pool.join()
+        self.datastore.flush()
+
+        self.next_index = max(self.next_index, latest + 1)
+        logger.info('Warmup loaded {count} comics up to {latest} in {t:.2f}s, {failed} failed'.format(
+            count=len(self.json_index), latest=latest, t=time.time() - start_time, failed=len(self.failed_ids)))
+
+    def load_from_datastore(self):
+        """
+        Builds the indexes from every comic stored in the datastore in one pass.
+        """
+        start_time = time.time()
+        for meta in self.datastore.iter_xkcd_meta():
+            self._index_meta(meta['comic_id'], meta)
+            self.next_index = max(self.next_index, meta['comic_id'] + 1)
+
+        logger.info('Loaded {count} comics from the datastore in {t:.2f}s'.format(count=len(self.json_index),
+                                                                                  t=time.time() - start_time))
+
     def _load_indexes(self):
+        if not self.json_index:
+            self.load_from_datastore()
+
         while True:
-            # Get metadata
-            meta = self._get_meta(self.next_index)
-            if not meta:
+            if not self._load_comic(self.next_index):
                 return
+            self.next_index += 1
 
-            # comic_id -> json
-            self.json_index[self.next_index] = meta['json_data']
+    def _load_comic(self, comic_id):
+        # Get metadata
+        meta = self._get_meta(comic_id)
+        if meta:
+            self._index_meta(comic_id, meta)
+            self.failed_ids.discard(comic_id)
+        return meta
 
-            # image_url_path_part -> comic_id
-            parsed = urlparse.urlparse(meta['json_data'].get('img', ''))
-            if parsed.path and parsed.path not in self.reverse_image_index:
-                self.reverse_image_index[parsed.path] = self.next_index
+    def _try_comic(self, comic_id):
+        # Comics the warmup or a refresh failed to load are retried by the next refresh
+        meta = self._load_comic(comic_id)
+        if not meta:
+            self.failed_ids.add(comic_id)
+        return meta
 
-            # avg_hash -> comic_id
-            if meta['hash_avg'] and meta['hash_avg'] not in self.reverse_hash_index:
-                self.reverse_hash_index[meta['hash_avg']] = self.next_index
+    def _index_meta(self, comic_id, meta):
+        # comic_id -> json
+        self.json_index[comic_id] = meta['json_data']
 
-            self.next_index += 1
+        # image_url_path_part -> comic_id
+        parsed = urlparse.urlparse(meta['json_data'].get('img', ''))
+        if parsed.path and parsed.path not in self.reverse_image_index:
+            self.reverse_image_index[parsed.path] = comic_id
+
+        # avg_hash -> comic_id
+        if meta['hash_avg'] and meta['hash_avg'] not in self.reverse_hash_index:
+            self.reverse_hash_index[meta['hash_avg']] = comic_id
 
     def _get_meta(self, comic_id):
         meta = self.datastore.get_xkcd_meta(comic_id)
         if not meta:
             comic_id, json_data, hash_avg, hash_d, hash_p = self._build_xkcd_meta(comic_id)
             if comic_id is not None:
+                # The row is queued, so build the meta from what was fetched instead of reading it back
                 self.datastore.insert_xkcd_meta(comic_id, json_data, hash_avg, hash_d, hash_p)
-                meta = self.datastore.get_xkcd_meta(comic_id)
+                meta = {
+                    'comic_id': comic_id,
+                    'json_data': json_data,
+                    'hash_avg': hash_avg,
+                    'hash_d': hash_d,
+                    'hash_p': hash_p,
+                }
         return meta
 
     def _build_xkcd_meta(self, comic_id):
@@ -104,14 +286,21 @@ class XkcdFetcher(object):
             os.remove(file_name)
     """
 
+    def _get_latest_comic_id(self):
+        try:
+            body = self.http_client.get(self.base_url + XKCD_LATEST_JSON_API_PATH)
+            return int(simplejson.loads(body)['num'])
+        except Exception as e:
+            logger.exception('Exception while getting the latest xkcd json')
+            return None
+
     def _get_xkcd_json(self, comic_id):
         if int(comic_id) == 404:
             return {'title': '404', 'transcript': '404', 'alt': '404', 'img': '', 'num': 404}
 
         try:
-            response = urllib2.urlopen(XKCD_JSON_API_URL.format(comic_id=comic_id))
-            html = response.read()
-            return simplejson.loads(html)
+            body = self.http_client.get(self.base_url + XKCD_JSON_API_PATH.format(comic_id=comic_id))
+            return simplejson.loads(body) if body else None
         except Exception as e:
             # logger.exception('Exception while getting xkcd json')
             return None
@@ -13,11 +13,14 @@ setuptools.setup(
         'Programming Language :: Python :: 2.7',
     ],
     packages=setuptools.find_packages(),
+    package_data={'redditbot.bots.xkcdref': ['bench_baseline.json']},
     namespace_packages=['redditbot'],
     entry_points={
         'console_scripts': [
             'runbot-emote-counter = redditbot.bots.emote_counter.runbot:run',
-            'runbot-xkcdref = redditbot.bots.xkcdref.runbot:run'
+            'runbot-xkcdref = redditbot.bots.xkcdref.runbot:run',
+            'bench-xkcdref = redditbot.bots.xkcdref.bench:run',
+            'replay-xkcdref = redditbot.bots.xkcdref.replay:run'
         ]
     }
 )